@@ -0,0 +1,83 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+Compare builds/sec of the threaded fetcher and the asyncio ingestion
+against the mock jenkins, both runs include test reports and label artifacts.
+
+    python benchmarks/bench_async_ingest.py --jobs 20 --builds 100 --latency 0.05
+"""
+import argparse
+import os
+import tempfile
+
+from benchmarks.common import BENCH_DBNAME, create_app, drop_database, Timer
+from benchmarks.mock_jenkins import MockJenkins
+
+
+def prepare(app, data_file):
+    from server.db.fetch_jenkins_info import JenkinsFetcher, populate_db
+    with app.app_context():
+        drop_database()
+    jf = JenkinsFetcher(app)
+    with app.app_context():
+        populate_db(jf.sites, jf.jobs, jf.labels, data_file)
+        jf.fetch_sites()
+    return jf
+
+
+def run_threaded(app, data_file, build_limit):
+    jf = prepare(app, data_file)
+    with app.app_context(), Timer() as t:
+        build_names = jf.fetch_builds(build_limit=build_limit)
+        jf.apply_labels_to_builds()
+        jf.fetch_test_results()
+    return len(build_names), t.elapsed
+
+
+def run_async(app, data_file, build_limit):
+    from server.db.async_ingest import run_async_ingest
+    jf = prepare(app, data_file)
+    with app.app_context(), Timer() as t:
+        build_names, ingester = run_async_ingest(build_limit=build_limit,
+                                                 mongo_uri=app.config['MONGO_URI'],
+                                                 dbname=BENCH_DBNAME)
+        jf.apply_labels_to_builds()
+    print(ingester.summary())
+    return len(build_names), t.elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sites", type=int, default=1)
+    parser.add_argument("--jobs", type=int, default=10, help="jobs per site")
+    parser.add_argument("--builds", type=int, default=50, help="builds per job")
+    parser.add_argument("--suites", type=int, default=5, help="suites per test report")
+    parser.add_argument("--cases", type=int, default=20, help="cases per suite")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every jenkins response")
+    parser.add_argument("-L", "--build_limit", default=None, help="limit the number of builds per job")
+    args = parser.parse_args()
+
+    mock = MockJenkins(sites=args.sites, jobs=args.jobs, builds=args.builds,
+                       suites=args.suites, cases=args.cases, latency=args.latency).start()
+    fd, data_file = tempfile.mkstemp(suffix=".data")
+    os.close(fd)
+    mock.write_data_file(data_file)
+    app = create_app()
+    try:
+        results = list()
+        for name, fn in (("threaded", run_threaded), ("async", run_async)):
+            builds, elapsed = fn(app, data_file, args.build_limit)
+            results.append((name, builds, elapsed))
+        for name, builds, elapsed in results:
+            print("{:<9} builds: {:>7}  time: {:>7.1f}s  builds/s: {:>8.1f}".format(
+                name, builds, elapsed, builds / max(elapsed, 1e-6)))
+    finally:
+        with app.app_context():
+            drop_database()
+        os.remove(data_file)
+        mock.stop()
+
+
+if __name__ == "__main__":
+    main()
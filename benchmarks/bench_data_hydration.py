@@ -0,0 +1,80 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+Compare per-record and batched hydration of build data records.
+
+    python benchmarks/bench_data_hydration.py -N 40000
+"""
+import argparse
+import json
+
+from benchmarks.common import command_counter, create_app, drop_database, Timer
+
+
+def seed(builds, num_builds):
+    data_docs = list()
+    for i in range(num_builds):
+        data_docs.append({"data": json.dumps({"number": i,
+                                              "timestamp": 1500000000000 + i,
+                                              "result": "SUCCESS",
+                                              "building": False})})
+    data_ids = builds.data_collection.insert_many(data_docs).inserted_ids
+    build_docs = list()
+    for i, data_id in enumerate(data_ids):
+        build_docs.append({"name": "site:job:{}".format(i),
+                           "url": "http://jenkins/job/job/{}".format(i),
+                           "data": str(data_id)})
+    builds.collection.insert_many(build_docs)
+
+
+def per_record_populate_data(model, documents, data_fields):
+    """
+    Hydration as done before batching: one find_one per document
+    """
+    r = list()
+    for doc in documents:
+        if doc.get('data'):
+            x = model.get_data_record(doc['data'])
+            if x.get('data') != 'null':
+                x = json.loads(x['data'])
+                doc['data'] = dict((f, x[f]) for f in data_fields.split(',') if f in x)
+                r.append(doc)
+    return r
+
+
+def run(model, name, fn):
+    command_counter.reset()
+    with Timer() as t:
+        res = fn()
+    print("{:<12} records: {:>7}  round trips: {:>7}  time: {:.3f}s".format(
+        name, len(res), command_counter.total('find', 'getMore'), t.elapsed))
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-N", "--num_builds", type=int, default=10000,
+                        help="number of builds to seed")
+    parser.add_argument("-F", "--data_fields", default="timestamp,result",
+                        help="data fields to populate")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context():
+        from server.db.models import JenkinsBuilds
+        builds = JenkinsBuilds()
+        drop_database()
+        seed(builds, args.num_builds)
+        try:
+            per_record = run(builds, "per-record",
+                             lambda: per_record_populate_data(builds, builds.get(), args.data_fields))
+            batched = run(builds, "batched",
+                          lambda: builds.get(data_fields=args.data_fields))
+            assert per_record == batched, "batched hydration returned different records"
+        finally:
+            drop_database()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+End-to-end benchmark: ingest the mock jenkins with fetch_jenkins_info.ingest,
+then request the main /api endpoints through the flask test client.
+Reports throughput, p50/p99 latency and peak RSS, -o writes the results as json
+so runs can be compared.
+
+    python benchmarks/bench_e2e.py --jobs 20 --builds 100 --latency 0.02 -N 50
+    python benchmarks/bench_e2e.py --mongomock -o results.json  # skips endpoints that need mongod
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import BENCH_DBNAME, command_counter, drop_database, peak_rss_mb, use_mongomock, Timer
+from benchmarks.mock_jenkins import MockJenkins
+from server.api.jenkins_http import percentile
+
+# (name, url, needs mongod), {report} is replaced by the name of an ingested test report.
+# Endpoints ordering builds numerically rely on collation and aggregation operators
+# mongomock ignores or lacks, they are skipped with --mongomock
+ENDPOINTS = [
+    ("sites", "/api/jenkins/sites/", False),
+    ("jobs", "/api/jenkins/jobs/", False),
+    ("builds", "/api/jenkins/builds/?data_fields=timestamp,result", False),
+    ("test_reports last", "/api/jenkins/test_reports/?last=1&data_fields=failCount,passCount", True),
+    ("report cases", "/api/jenkins/test_reports/{report}/cases", False),
+    ("reporter tests", "/api/reporter/tests?data_fields=timestamp,result,failCount,passCount", False),
+    ("reporter summary", "/api/reporter/summary", False),
+    ("reporter platform", "/api/reporter/platform/mock", True),
+    ("reporter stats", "/api/reporter/stats", False),
+]
+
+
+def bench_ingest(app, data_file, args):
+    from server.db.fetch_jenkins_info import ingest
+    command_counter.reset()
+    with Timer() as t:
+        jf = ingest(app, data_file,
+                    get_builds=True,
+                    get_tests=True,
+                    build_limit=args.build_limit,
+                    async_ingest=args.async_ingest,
+                    workers=args.workers)
+    jf.print_summary()
+    with app.app_context():
+        builds = jf.builds.get_count()
+        reports = jf.test_reports.get_count()
+    return {
+        "time": t.elapsed,
+        "builds": builds,
+        "test_reports": reports,
+        "builds_per_sec": builds / max(t.elapsed, 1e-6),
+        "test_reports_per_sec": reports / max(t.elapsed, 1e-6),
+        "mongo_commands": command_counter.total(),
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+
+def bench_endpoint(app, url, num_requests, concurrency):
+    def request(_):
+        client = app.test_client()
+        start = time.time()
+        resp = client.get(url)
+        return time.time() - start, resp.status_code, len(resp.get_data())
+
+    command_counter.reset()
+    with Timer() as t:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(request, range(num_requests)))
+    latencies = [x[0] for x in results]
+    errors = [x[1] for x in results if x[1] >= 400]
+    return {
+        "requests": num_requests,
+        "errors": len(errors),
+        "status": errors and errors[0] or results[0][1],
+        "bytes": results[0][2],
+        "req_per_sec": num_requests / max(t.elapsed, 1e-6),
+        "p50_ms": 1000 * percentile(latencies, 50),
+        "p99_ms": 1000 * percentile(latencies, 99),
+        "mongo_commands_per_request": command_counter.total() / float(num_requests),
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sites", type=int, default=1)
+    parser.add_argument("--jobs", type=int, default=10, help="jobs per site")
+    parser.add_argument("--builds", type=int, default=50, help="builds per job")
+    parser.add_argument("--suites", type=int, default=5, help="suites per test report")
+    parser.add_argument("--cases", type=int, default=20, help="cases per suite")
+    parser.add_argument("--artifacts", type=int, default=1, help="artifacts per build")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every jenkins response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="max random seconds added on top of latency")
+    parser.add_argument("-L", "--build_limit", default=None, help="limit the number of builds per job")
+    parser.add_argument("-W", "--workers", type=int, default=16, help="ingestion workers")
+    parser.add_argument("-A", "--async_ingest", action='store_true', help="ingest with asyncio")
+    parser.add_argument("-N", "--num_requests", type=int, default=20, help="requests per endpoint")
+    parser.add_argument("-C", "--concurrency", type=int, default=1, help="concurrent requests per endpoint")
+    parser.add_argument("--mongomock", action='store_true', help="use in-memory mongomock instead of mongod")
+    parser.add_argument("-o", "--output", default=None, help="write results as json")
+    args = parser.parse_args()
+    if args.mongomock and args.async_ingest:
+        parser.error("async ingestion needs mongod")
+
+    mock = MockJenkins(sites=args.sites, jobs=args.jobs, builds=args.builds,
+                       suites=args.suites, cases=args.cases, artifacts=args.artifacts,
+                       latency=args.latency, jitter=args.jitter).start()
+    fd, data_file = tempfile.mkstemp(suffix=".data")
+    os.close(fd)
+    mock.write_data_file(data_file)
+
+    if args.mongomock:
+        use_mongomock()
+    from server.app import app, initialize_app
+    initialize_app(app,
+                   MONGO_DBNAME=BENCH_DBNAME,
+                   MONGO_URI="mongodb://localhost:27017/{}".format(BENCH_DBNAME),
+                   MONGO_ENSURE_INDEXES=not args.mongomock)
+    results = {"args": vars(args), "endpoints": dict(), "skipped": list()}
+    try:
+        with app.app_context():
+            drop_database()
+        results["ingest"] = bench_ingest(app, data_file, args)
+        results["ingest"]["jenkins_requests"] = mock.requests
+        with app.app_context():
+            from server.db.models import JenkinsTestReports
+            report = JenkinsTestReports().get(data=True)
+        report = report and report[0]['name'] or "none"
+        for name, url, needs_mongod in ENDPOINTS:
+            if needs_mongod and args.mongomock:
+                results["skipped"].append(name)
+                continue
+            results["endpoints"][name] = bench_endpoint(app, url.format(report=report),
+                                                         args.num_requests, args.concurrency)
+    finally:
+        with app.app_context():
+            drop_database()
+        os.remove(data_file)
+        mock.stop()
+
+    x = results["ingest"]
+    print("ingest: {builds} builds, {test_reports} test reports in {time:.1f}s, "
+          "{builds_per_sec:.1f} builds/s, {test_reports_per_sec:.1f} reports/s, "
+          "{jenkins_requests} jenkins requests, {mongo_commands} mongo commands, "
+          "peak RSS {peak_rss_mb:.0f}MB".format(**x))
+    print("{:<20} {:>6} {:>8} {:>9} {:>9} {:>9} {:>10} {:>9}".format(
+        "endpoint", "status", "req/s", "p50 ms", "p99 ms", "bytes", "mongo/req", "RSS MB"))
+    for name, _, _ in ENDPOINTS:
+        if name not in results["endpoints"]:
+            continue
+        x = results["endpoints"][name]
+        print("{:<20} {status:>6} {req_per_sec:>8.1f} {p50_ms:>9.1f} {p99_ms:>9.1f} {bytes:>9} "
+              "{mongo_commands_per_request:>10.1f} {peak_rss_mb:>9.0f}".format(name, **x))
+    if results["skipped"]:
+        print("skipped with mongomock: {}".format(", ".join(results["skipped"])))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+Time the fe_flask platform page on a synthetic /api/reporter/platform/<label> response:
+json parsing, frame preparation (views.platform_frame) and html tables (views.render_platform_tables),
+the work platform_view does on a fragment cache miss. Needs pandas and flask, no mongod.
+
+    python benchmarks/bench_platform_view.py -N 30000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fe_flask"))
+from views import platform_frame, render_platform_tables  # noqa: E402
+
+
+def synthetic_rows(num_rows, num_jobs=50, num_branches=20):
+    rows = list()
+    for i in range(num_rows):
+        job = "site:folder:job{}".format(i % num_jobs)
+        number = i // num_jobs + 1
+        fail_count = i % 4
+        pass_count = 100 + i % 50
+        rows.append({"branch": "1.{}.{}".format(i % 3, i % num_branches),
+                     "job": job,
+                     "name": "{}:{}".format(job, number),
+                     "url": "http://jenkins/job/folder/job/job{}/{}".format(i % num_jobs, number),
+                     "label": "1.{}.{}.{}".format(i % 3, i % num_branches, number),
+                     "number": number,
+                     "timestamp": 1500000000000 + 1000 * i,
+                     "result": "SUCCESS" if i % 5 else "FAILURE",
+                     "test_report": "{}:{}:testReport".format(job, number),
+                     "failCount": fail_count,
+                     "passCount": pass_count,
+                     "skipCount": 0,
+                     "duration": 1.5 * (i % 100),
+                     "total": fail_count + pass_count})
+    return rows
+
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return result, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-N", "--num_rows", type=int, default=30000,
+                        help="number of (branch, job) rows in the synthetic response")
+    args = parser.parse_args()
+
+    body = json.dumps(synthetic_rows(args.num_rows))
+    rows, parse_time = timed(json.loads, body)
+    df, frame_time = timed(platform_frame, rows)
+    tables, render_time = timed(render_platform_tables, "mock", df)
+    total = parse_time + frame_time + render_time
+    print("rows: {}, branches: {}, html: {} bytes".format(
+        len(df), len(tables), sum(len(x['html']) for x in tables)))
+    for name, elapsed in (("json parsing", parse_time),
+                          ("platform_frame", frame_time),
+                          ("render_platform_tables", render_time),
+                          ("total", total)):
+        print("{:<24} {:.3f}s".format(name, elapsed))
+    print("{:.0f} rows/s".format(len(df) / max(total, 1e-9)))
+
+
+if __name__ == "__main__":
+    main()
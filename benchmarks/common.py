@@ -0,0 +1,92 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+Helpers shared by the benchmark scripts.
+Benchmarks need a running mongod, they use their own database which is dropped at the end.
+"""
+import os
+import resource
+import threading
+import time
+
+from pymongo import monitoring
+
+os.environ.setdefault("SECRET_KEY", "benchmark")
+
+BENCH_DBNAME = "reporting_benchmark"
+
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Counts mongo commands (round trips) issued by the process
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = dict()
+
+    def started(self, event):
+        with self.lock:
+            self.counts[event.command_name] = self.counts.get(event.command_name, 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def reset(self):
+        with self.lock:
+            self.counts = dict()
+
+    def total(self, *command_names):
+        with self.lock:
+            if command_names:
+                return sum(self.counts.get(x, 0) for x in command_names)
+            return sum(self.counts.values())
+
+
+command_counter = CommandCounter()
+# listener has to be registered before the mongo client is created
+monitoring.register(command_counter)
+
+
+def create_app(dbname=BENCH_DBNAME):
+    from flask import Flask
+    from server.db import db
+
+    app = Flask(__name__)
+    app.config['MONGO_DBNAME'] = dbname
+    app.config['MONGO_URI'] = "mongodb://localhost:27017/{}".format(dbname)
+    db.init_app(app)
+    return app
+
+
+def use_mongomock():
+    """
+    Make flask_pymongo connect to in-memory mongomock, call before db.init_app.
+    Mongo commands are not counted, explain is not supported and collation is ignored,
+    so build numbers are ordered as strings: results relying on numeric ordering are wrong.
+    """
+    import flask_pymongo
+    import mongomock
+    flask_pymongo.MongoClient = mongomock.MongoClient
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def drop_database(dbname=BENCH_DBNAME):
+    from server.db import db
+    db.cx.drop_database(dbname)
+
+
+class Timer(object):
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.time() - self.start
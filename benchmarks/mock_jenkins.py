@@ -0,0 +1,301 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+Mock jenkins serving generated sites, jobs, builds, test reports and artifacts,
+used by the ingestion benchmarks. Site i is served under /site<i>, data is generated
+on request from (job, build) so any number of builds costs no memory.
+
+    python -m benchmarks.mock_jenkins --port 8080 --jobs 10 --builds 100 --latency 0.05
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# array ranges of jenkins tree expressions, e.g. builds[number,url]{0,100}
+TREE_RANGE = re.compile(r'(\w+)\[[^\[\]]*\]\{(\d+),(\d+)\}')
+PATH = re.compile(r'^/site(?P<site>\d+)'
+                  r'(?:/job/job(?P<job>\d+)'
+                  r'(?:/(?P<build>\d+)'
+                  r'(?:/(?P<report>testReport)|/artifact/(?P<artifact>.+?))?)?)?'
+                  r'(?:/api/json)?/?$')
+ARTIFACT_NAME = "build_info.json"
+# jenkins lists at most this many builds of a job in builds, all of them in allBuilds
+JENKINS_MAX_BUILDS = 100
+PLATFORMS = ["linux", "windows", "macos"]
+
+
+def tree_ranges(tree):
+    """
+    :return: dict of array name to (start, end)
+    """
+    return dict((m.group(1), (int(m.group(2)), int(m.group(3))))
+                for m in TREE_RANGE.finditer(tree or ""))
+
+
+class MockJenkins(object):
+    def __init__(self, sites=1, jobs=10, builds=50, suites=5, cases=20,
+                 artifacts=1, artifact_bytes=1024, latency=0.0, jitter=0.0, building=0,
+                 host="127.0.0.1", port=0):
+        """
+        :param jobs: jobs per site
+        :param builds: builds per job
+        :param suites: suites per test report
+        :param cases: cases per suite
+        :param artifacts: artifacts per build, the first one is json used by the mock label
+        :param artifact_bytes: size of the other artifacts
+        :param latency: seconds added to every response
+        :param jitter: max random seconds added on top of latency
+        :param building: number of newest builds of each job still running
+        """
+        self.num_sites = sites
+        self.num_jobs = jobs
+        self.num_builds = builds
+        self.num_suites = suites
+        self.num_cases = cases
+        self.num_artifacts = artifacts
+        self.artifact_bytes = artifact_bytes
+        self.latency = latency
+        self.jitter = jitter
+        self.building = building
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.handler_class())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def site_url(self, site):
+        return "{}/site{}".format(self.url, site)
+
+    def job_url(self, site, job):
+        return "{}/job/job{}".format(self.site_url(site), job)
+
+    def build_url(self, site, job, build):
+        return "{}/{}".format(self.job_url(site, job), build)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def data(self):
+        """
+        :return: content of the data file read by fetch_jenkins_info.py -F
+        """
+        return {
+            "sites": [{"name": "mock{}".format(s),
+                       "url": self.site_url(s),
+                       "username": "",
+                       "api_key": ""}
+                      for s in range(self.num_sites)],
+            "jobs": [{"url": self.job_url(s, j), "label": "mock"}
+                     for s in range(self.num_sites) for j in range(self.num_jobs)],
+            "labels": [{"name": "mock platform",
+                        "url": "BUILD_ARTIFACT_API",
+                        "artifact_pattern": repr([ARTIFACT_NAME]),
+                        "parser": "lambda x: x['platform']",
+                        "build_name_patterns": ["mock"]}]
+        }
+
+    def write_data_file(self, fname):
+        with open(fname, 'w') as f:
+            f.write(repr(self.data()))
+
+    def site(self, site):
+        return {
+            "mode": "NORMAL",
+            "nodeName": "",
+            "nodeDescription": "mock jenkins",
+            "numExecutors": 0,
+            "description": None,
+            "jobs": [{"name": "job{}".format(j),
+                      "url": self.job_url(site, j) + "/",
+                      "color": "blue"}
+                     for j in range(self.num_jobs)]
+        }
+
+    def job(self, site, job, ranges):
+        # newest build first, as jenkins does
+        numbers = list(range(self.num_builds, 0, -1))
+        return {
+            "name": "job{}".format(job),
+            "fullName": "job{}".format(job),
+            "displayName": "job{}".format(job),
+            "url": self.job_url(site, job) + "/",
+            "description": "",
+            "buildable": True,
+            "color": "blue",
+            "inQueue": False,
+            "lastBuild": {"number": self.num_builds},
+            "lastCompletedBuild": {"number": self.num_builds - self.building},
+            "builds": self.build_list(site, job, numbers[:JENKINS_MAX_BUILDS], ranges.get('builds')),
+            "allBuilds": self.build_list(site, job, numbers, ranges.get('allBuilds'))
+        }
+
+    def build_list(self, site, job, numbers, array_range):
+        start, end = array_range or (0, len(numbers))
+        return [{"number": n, "url": self.build_url(site, job, n) + "/"} for n in numbers[start:end]]
+
+    def build(self, site, job, build):
+        rnd = random.Random("{}:{}:{}".format(site, job, build))
+        artifacts = [ARTIFACT_NAME] + ["logs/output{}.txt".format(i) for i in range(1, self.num_artifacts)]
+        return {
+            "id": str(build),
+            "number": build,
+            "url": self.build_url(site, job, build) + "/",
+            "displayName": "#{}".format(build),
+            "fullDisplayName": "job{} #{}".format(job, build),
+            "description": None,
+            "result": rnd.choice(["SUCCESS", "SUCCESS", "SUCCESS", "UNSTABLE", "FAILURE"]),
+            "building": build > self.num_builds - self.building,
+            "timestamp": 1500000000000 + 3600000 * build,
+            "duration": rnd.randint(60000, 3600000),
+            "estimatedDuration": 1800000,
+            "builtOn": "node{}".format(rnd.randint(0, 9)),
+            "artifacts": [{"fileName": x.split('/')[-1], "relativePath": x}
+                          for x in artifacts[:self.num_artifacts]],
+            "actions": [{"parameters": [{"name": "BRANCH", "value": "master"}]},
+                        {"causes": [{"shortDescription": "Started by timer"}]}]
+        }
+
+    def test_report(self, site, job, build, ranges):
+        rnd = random.Random("{}:{}:{}:testReport".format(site, job, build))
+        start, end = ranges.get('cases', (0, self.num_cases))
+        counts = {"PASSED": 0, "FAILED": 0, "SKIPPED": 0}
+        suites = list()
+        for s in range(self.num_suites):
+            cases = list()
+            for c in range(self.num_cases):
+                status = rnd.choice(["PASSED"] * 18 + ["FAILED", "SKIPPED"])
+                counts[status] += 1
+                if not start <= c < end:
+                    continue
+                cases.append({"className": "tests.suite{}.TestClass".format(s),
+                              "name": "test_{}".format(c),
+                              "status": status,
+                              "duration": round(rnd.random(), 3),
+                              "age": 0,
+                              "errorDetails": "assert failed" if status == "FAILED" else None,
+                              "errorStackTrace": None,
+                              "skipped": status == "SKIPPED",
+                              "skippedMessage": None,
+                              "failedSince": build if status == "FAILED" else 0})
+            suites.append({"name": "suite{}".format(s),
+                           "id": None,
+                           "duration": round(sum(x['duration'] for x in cases), 3),
+                           "timestamp": None,
+                           "enclosingBlockNames": [],
+                           "cases": cases})
+        return {
+            "duration": round(sum(x['duration'] for x in suites), 3),
+            "empty": False,
+            "failCount": counts["FAILED"],
+            "passCount": counts["PASSED"],
+            "skipCount": counts["SKIPPED"],
+            "suites": suites
+        }
+
+    def artifact(self, site, job, build, path):
+        if path == ARTIFACT_NAME:
+            rnd = random.Random("{}:{}:{}:artifact".format(site, job, build))
+            return json.dumps({"platform": rnd.choice(PLATFORMS), "build": build}).encode('utf-8')
+        return b"x" * self.artifact_bytes
+
+    def respond(self, path, query):
+        """
+        :return: (status, content type, body)
+        """
+        m = PATH.match(path)
+        if not m:
+            return 404, "text/plain", b"not found"
+        site = int(m.group('site'))
+        job = m.group('job') and int(m.group('job'))
+        build = m.group('build') and int(m.group('build'))
+        if site >= self.num_sites or (job is not None and job >= self.num_jobs) or \
+                (build is not None and not 0 < build <= self.num_builds):
+            return 404, "text/plain", b"not found"
+        ranges = tree_ranges(query.get('tree', [None])[0])
+        if m.group('artifact'):
+            return 200, "application/octet-stream", self.artifact(site, job, build, m.group('artifact'))
+        if m.group('report'):
+            data = self.test_report(site, job, build, ranges)
+        elif build is not None:
+            data = self.build(site, job, build)
+        elif job is not None:
+            data = self.job(site, job, ranges)
+        else:
+            data = self.site(site)
+        return 200, "application/json", json.dumps(data).encode('utf-8')
+
+    def handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with mock.lock:
+                    mock.requests += 1
+                if mock.latency or mock.jitter:
+                    time.sleep(mock.latency + random.uniform(0, mock.jitter))
+                url = urlparse(self.path)
+                status, content_type, body = mock.respond(url.path, parse_qs(url.query))
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--sites", type=int, default=1)
+    parser.add_argument("--jobs", type=int, default=10, help="jobs per site")
+    parser.add_argument("--builds", type=int, default=50, help="builds per job")
+    parser.add_argument("--suites", type=int, default=5, help="suites per test report")
+    parser.add_argument("--cases", type=int, default=20, help="cases per suite")
+    parser.add_argument("--artifacts", type=int, default=1, help="artifacts per build")
+    parser.add_argument("--artifact_bytes", type=int, default=1024, help="size of non json artifacts")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="max random seconds added on top of latency")
+    parser.add_argument("--building", type=int, default=0, help="newest builds of each job still running")
+    parser.add_argument("-F", "--data_file", default=None,
+                        help="write data file for fetch_jenkins_info.py -F")
+    args = parser.parse_args()
+
+    mock = MockJenkins(sites=args.sites, jobs=args.jobs, builds=args.builds,
+                       suites=args.suites, cases=args.cases, artifacts=args.artifacts,
+                       artifact_bytes=args.artifact_bytes, latency=args.latency, jitter=args.jitter,
+                       building=args.building, host=args.host, port=args.port)
+    if args.data_file:
+        mock.write_data_file(args.data_file)
+    print("mock jenkins at {}".format(mock.url))
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        mock.stop()
+
+
+if __name__ == "__main__":
+    main()
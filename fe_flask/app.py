@@ -2,9 +2,16 @@
 # LICENSE file in the root directory of this project.
 
 import argparse
+import os
+import sys
 from flask import Flask, current_app, render_template
+import settings
 from settings import USE_ANGULAR
 
+# profiler is shared with the report server
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from server.profiler import init_profiler
+
 
 if USE_ANGULAR:
     app = Flask(__name__, static_folder='../dist')
@@ -35,6 +42,10 @@ else:
         return test_report_view(platform, label, name)
 
 
+app.config.from_object(settings)
+init_profiler(app)
+
+
 def main():
     parser = argparse.ArgumentParser()
     default_host = "localhost"
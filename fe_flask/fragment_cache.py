@@ -0,0 +1,191 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+Cache of rendered page fragments, keyed by view arguments and the report server data version
+of the collections the view reads. The version changes whenever one of them is written,
+entries of older versions are dropped then.
+With FRAGMENT_CACHE_DIR set, fragments are also stored on disk as json so that all workers share them.
+"""
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+from settings import REPORTER_API_URL, \
+    FRAGMENT_CACHE_ENABLED, \
+    FRAGMENT_CACHE_MAX_ENTRIES, \
+    FRAGMENT_CACHE_DIR, \
+    FRAGMENT_CACHE_VERSION_TTL
+
+log = logging.getLogger(__name__)
+
+
+class NoCache(object):
+    """
+    Result of a cached function that must not be cached, e.g. a page rendered without report server data
+    """
+    def __init__(self, value):
+        self.value = value
+
+
+def private_directory(directory):
+    """
+    Create directory readable and writable by this user only
+    :return: directory, None if it is owned by another user or accessible by others
+    """
+    if not directory:
+        return None
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        st = os.stat(directory)
+    except OSError as e:
+        log.warning("fragment cache directory {} not used: {}".format(directory, e))
+        return None
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        log.warning("fragment cache directory {} not used, it has to be owned by this user "
+                    "with mode 0700".format(directory))
+        return None
+    return directory
+
+
+def uncached(value):
+    return value.value if isinstance(value, NoCache) else value
+
+
+class FragmentCache(object):
+    def __init__(self, maxsize, directory=None, version_ttl=5):
+        """
+        :param maxsize: max number of in-process entries
+        :param directory: shared on-disk store, None to keep entries in-process only
+        :param version_ttl: seconds a data version is reused before asking report server again
+        """
+        self.maxsize = maxsize
+        self.directory = private_directory(directory)
+        self.version_ttl = version_ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # collections group -> (version, time checked)
+        self.versions = dict()
+
+    def data_version(self, group):
+        """
+        :param group: collections joined with '+'
+        :return: report server data version of the collections, None if it can't be read
+        """
+        now = time.time()
+        with self.lock:
+            version, checked = self.versions.get(group, (None, 0))
+        if version is not None and now - checked < self.version_ttl:
+            return version
+        try:
+            r = requests.get("{}/version".format(REPORTER_API_URL),
+                             params={"collections": group.replace('+', ',')},
+                             timeout=5)
+            new_version = r.ok and r.json()['version'] or None
+        except (requests.RequestException, ValueError, KeyError):
+            new_version = None
+        with self.lock:
+            if new_version != version:
+                for key in [k for k in self.entries if k[0] == group and k[1] != new_version]:
+                    del self.entries[key]
+                if new_version is not None:
+                    self.drop_old_versions(group, new_version)
+            self.versions[group] = (new_version, now)
+        return new_version
+
+    def drop_old_versions(self, group, version):
+        path = self.directory and os.path.join(self.directory, group)
+        if not path or not os.path.isdir(path):
+            return
+        for name in os.listdir(path):
+            if name != version:
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+    def get(self, group, version, key):
+        """
+        :return: (found, value)
+        """
+        with self.lock:
+            if (group, version, key) in self.entries:
+                self.entries.move_to_end((group, version, key))
+                return True, self.entries[(group, version, key)]
+        if self.directory:
+            try:
+                with open(os.path.join(self.directory, group, version, key)) as f:
+                    value = json.load(f)
+            except Exception:
+                # missing or corrupt entry
+                return False, None
+            self.set_local(group, version, key, value)
+            return True, value
+        return False, None
+
+    def set_local(self, group, version, key, value):
+        with self.lock:
+            self.entries[(group, version, key)] = value
+            self.entries.move_to_end((group, version, key))
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def set(self, group, version, key, value):
+        self.set_local(group, version, key, value)
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, group, version)
+        try:
+            body = json.dumps(value)
+        except (TypeError, ValueError) as e:
+            log.warning("fragment not stored on disk: {}".format(e))
+            return
+        try:
+            os.makedirs(path, mode=0o700, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=path, suffix=".tmp")
+            with os.fdopen(fd, 'w') as f:
+                f.write(body)
+            # readers in other workers never see partial files
+            os.replace(tmp, os.path.join(path, key))
+        except (IOError, OSError):
+            pass
+
+    def cached(self, *collections):
+        """
+        Cache results of the decorated function by its name, arguments and the data version
+        of the collections it reads, not cached while the data version is unknown.
+        Results wrapped in NoCache are returned unwrapped and not cached
+        :param collections: report server collections the function reads
+        """
+        group = "+".join(sorted(collections))
+
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args):
+                if not FRAGMENT_CACHE_ENABLED:
+                    return uncached(fn(*args))
+                version = self.data_version(group)
+                if version is None:
+                    return uncached(fn(*args))
+                key = hashlib.sha1(repr((fn.__name__, args)).encode('utf-8')).hexdigest()
+                found, value = self.get(group, version, key)
+                if found:
+                    return value
+                value = fn(*args)
+                if isinstance(value, NoCache):
+                    return value.value
+                self.set(group, version, key, value)
+                return value
+            return wrapper
+        return decorator
+
+
+fragment_cache = FragmentCache(FRAGMENT_CACHE_MAX_ENTRIES,
+                               directory=FRAGMENT_CACHE_DIR,
+                               version_ttl=FRAGMENT_CACHE_VERSION_TTL)
@@ -1,3 +1,23 @@
 # in future replace dist-flask with dist/ and place AngularJS front-end there
 USE_ANGULAR = False
-API_URL = "http://0.0.0.0:5000/api/jenkins"
\ No newline at end of file
+API_URL = "http://0.0.0.0:5000/api/jenkins"
+REPORTER_API_URL = "http://0.0.0.0:5000/api/reporter"
+
+# rendered tables cache (fragment_cache.py), entries are dropped when collections they are built from change
+FRAGMENT_CACHE_ENABLED = True
+FRAGMENT_CACHE_MAX_ENTRIES = 128
+# directory shared by workers, e.g. "/var/cache/test-reporter/fragments", None keeps entries in-process only.
+# Created with mode 0700, not used if owned by another user or accessible by others
+FRAGMENT_CACHE_DIR = None
+# seconds the report server data version is reused
+FRAGMENT_CACHE_VERSION_TTL = 5
+
+# Request profiler (server/profiler.py), see the module docstring
+PROFILER_ENABLED = False
+# "cprofile" or "sample"
+PROFILER_MODE = "cprofile"
+PROFILER_THRESHOLD = 1.0
+PROFILER_SAMPLE_RATE = 0.0
+PROFILER_DIR = "profiles/fe_flask"
+PROFILER_MAX_FILES = 100
+PROFILER_PATH = "/admin/profiles"
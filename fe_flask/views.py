@@ -3,10 +3,14 @@ from flask import render_template
 import json
 import requests
 import pandas as pd
-from settings import API_URL
+from settings import API_URL, REPORTER_API_URL
+from fragment_cache import fragment_cache, NoCache
 
-# to avoid truncation
-pd.set_option('display.max_colwidth', -1)
+# to avoid truncation, pandas >= 1.0 takes None instead of -1
+try:
+    pd.set_option('display.max_colwidth', -1)
+except ValueError:
+    pd.set_option('display.max_colwidth', None)
 
 
 def convert_times(date_from, date_to):
@@ -52,23 +56,6 @@ def get_jobs():
     return _get_data_as_dataframe(uri)
 
 
-def get_builds(job_label):
-    # get only completed builds
-    data_fields = "timestamp,result"
-    uri = "{}/builds/?building=0&job_label={}&data_fields={}".format(API_URL, job_label, data_fields)
-    df = _get_data_as_dataframe(uri)
-    # remove records without labels
-    df = df.dropna(subset=['label'])
-    df['temp'] = df['name'].apply(lambda x: str({"build": x.split(':')[-1], "job": ":".join(x.split(':')[:-1])}))
-    df = pd_spread_to_columns(df, 'temp')
-    if data_fields:
-        df = pd_spread_to_columns(df, 'data')
-        df['date'] = df['timestamp'].apply(
-            lambda x: pd.to_datetime(int(x)/1000, unit='s'))
-    # print(df.iloc[0, :])
-    return df
-
-
 def create_product_list(df):
     products = list()
     columns = ["short_name", "url_y", "failCount", "passCount", "total"]
@@ -85,19 +72,6 @@ def create_product_list(df):
     return products
 
 
-def pd_spread_to_columns(df, col_name):
-    existing_cols = df.columns
-    df2 = df[col_name].apply(lambda x: eval(x))
-    for k in df2.iloc[0].keys():
-        if k in existing_cols:
-            new_k = "{}_{}".format(col_name, k)
-        else:
-            new_k = k
-        df[new_k] = df2.apply(lambda x: x[k])
-    del df[col_name]
-    return df
-
-
 def pd_embed_url(df, col_name, url_col_name, new_tab=True):
     if new_tab:
         new_tab = "\" target=\"_blank\">"
@@ -121,22 +95,23 @@ def pd_to_html(df, **kwargs):
     return df_html
 
 
-def get_test_reports(names=None):
+def get_test_summary():
     """
-    
-    :param names: build names on report server
-    :return: 
+    Test results of the latest test report of every job, maintained by report server
+    :return: None if report server request failed
     """
-    fields = "suites,failCount,skipCount,duration,passCount"
-    uri = "{}/test_reports/?data_only=1&last=1&data_fields={}".format(API_URL, fields)
-    if names:
-        names_str = ",".join(names)
-        uri = "{}&names={}".format(uri, names_str)
-    df = _get_data_as_dataframe(uri)
+    uri = "{}/summary".format(REPORTER_API_URL)
+    out = _get_data_as_json(uri)
+    if out is None:
+        return None
+    return test_summary_frame(out)
+
 
-    test_reports = pd_spread_to_columns(df, 'data')
-    test_reports["total"] = test_reports["failCount"] + test_reports["passCount"]
-    return test_reports
+def test_summary_frame(out):
+    columns = ["job", "label", "name", "url", "failCount", "passCount", "skipCount", "duration"]
+    df = pd.DataFrame(out, columns=columns)
+    df["total"] = df["failCount"] + df["passCount"]
+    return df
 
 
 def get_test_suites(name):
@@ -161,59 +136,78 @@ def get_test_suites(name):
     return df
 
 
-def home_view():
+@fragment_cache.cached('jenkins_jobs', 'jenkins_summaries')
+def home_products():
     df_jobs = get_jobs()
-    if isinstance(df_jobs, pd.DataFrame):
-        df_jobs["short_name"] = df_jobs["name"].apply(lambda x: x.split(":")[-1])
-        df_test_reports = get_test_reports()
-        jobs_with_reports = pd.merge(df_jobs,
-                                     df_test_reports,
-                                     how="left",
-                                     left_on="name",
-                                     right_on="job")
-        products = create_product_list(jobs_with_reports)
-    else:
-        products = [
+    if not isinstance(df_jobs, pd.DataFrame):
+        # report server error or no jobs defined yet, not cached
+        return NoCache([
             {"name": "Looks like no jenkins jobs are defined",
              "jobs": []}
-        ]
-    return render_template('index.html', products=products)
+        ])
+    df_jobs["short_name"] = df_jobs["name"].str.rsplit(":", n=1).str[-1]
+    df_test_reports = get_test_summary()
+    summary_failed = df_test_reports is None
+    if summary_failed:
+        df_test_reports = test_summary_frame([])
+    # job label is taken from jobs
+    jobs_with_reports = pd.merge(df_jobs,
+                                 df_test_reports.drop(columns=["label"]),
+                                 how="left",
+                                 left_on="name",
+                                 right_on="job")
+    products = create_product_list(jobs_with_reports)
+    # shown without test results, not cached
+    return NoCache(products) if summary_failed else products
 
 
-def platform_view(name):
+def home_view():
+    return render_template('index.html', products=home_products())
+
+
+def get_platform(name):
     """
-    TODO:
-        1. get all jobs for label Maglev
-        2. get all builds for given job list
-        3. group results by version (label at build level)
-    :param name: 
-    :return: 
+    Latest build of every (branch, job) of the platform with its test results, aggregated by report server
+    :param name: job label
+    :return: None if report server request failed
     """
-    df_builds_all = get_builds(job_label=name)
-
-    df_builds_all['branch'] = df_builds_all['label'].apply(get_first_n, args=(3,), sep=".")
-    # TODO retain only latest build that has test results
-    # TODO the latest build might not have test results
-
-    df_builds = df_builds_all.groupby(['branch', 'job']).max().reset_index()
-    # now populate with test results
-    build_names = df_builds['name'].tolist()
-    df_test_reports = get_test_reports(names=build_names)
-
-    df_test_reports['build_name'] = df_test_reports['name'].apply(get_first_n, args=(-1,), sep=":")
-    df_builds = pd.merge(df_builds,
-                         df_test_reports,
-                         how="left",
-                         left_on="name",
-                         right_on="build_name")
-    # df_builds = pd_embed_url(df_builds, 'name_x', 'url_x')
-    df_builds['tr_url'] = df_builds.apply(lambda x: "/platform/{}/label/{}/test_report/{}".format(name, x['label'], x['name_y']), axis=1)
-    df_builds = pd_embed_url(df_builds, 'name_x', 'tr_url', new_tab=False)
-    df_builds = df_builds.sort_values(['label', 'failCount'], ascending=False)
+    uri = "{}/platform/{}".format(REPORTER_API_URL, name)
+    out = _get_data_as_json(uri)
+    if out is None:
+        return None
+    return platform_frame(out)
+
+
+def platform_frame(out):
+    """
+    :param out: rows of /api/reporter/platform/<label>
+    """
+    columns = ["branch", "job", "name", "url", "label", "number", "timestamp", "result",
+               "test_report", "failCount", "passCount", "skipCount", "duration", "total"]
+    df = pd.DataFrame(out or [], columns=columns)
+    df['date'] = pd.to_datetime(df['timestamp'], unit='ms')
+    return df
+
+
+@fragment_cache.cached('jenkins_jobs', 'jenkins_builds', 'jenkins_test_reports')
+def platform_tables(name):
+    df_builds = get_platform(name)
+    if df_builds is None:
+        # report server error, not cached
+        return NoCache(list())
+    return render_platform_tables(name, df_builds)
 
-    # print(df_builds.iloc[0, :])
 
-    cols = ["label", "name_x", "failCount", "total", "duration", "date", "result"]
+def render_platform_tables(name, df_builds):
+    """
+    :return: html table of builds per branch
+    """
+    df_builds['tr_url'] = "/platform/{}/label/".format(name) + df_builds['label'].astype(str) + \
+        "/test_report/" + df_builds['test_report'].astype(str)
+    df_builds = pd_embed_url(df_builds, 'name', 'tr_url', new_tab=False)
+    df_builds = df_builds.sort_values(['label', 'failCount'], ascending=False)
+
+    cols = ["label", "name", "failCount", "total", "duration", "date", "result"]
     branches = df_builds['branch'].unique()
     builds_htmls = list()
     for branch in branches:
@@ -224,19 +218,24 @@ def platform_view(name):
         builds_htmls.append(
             {
                 "branch": branch,
-                "failed": failed,
-                "total": total,
+                "failed": int(failed),
+                "total": int(total),
                 "html": builds_html
             }
         )
-    return render_template('platform.html', name=name, data=builds_htmls)
+    return builds_htmls
+
+
+def platform_view(name):
+    return render_template('platform.html', name=name, data=platform_tables(name))
 
 
 def branch_view(platform, name):
     return render_template('branch.html', platform=platform, name=name)
 
 
-def test_report_view(platform, label, name):
+@fragment_cache.cached('jenkins_test_reports', 'jenkins_suites', 'jenkins_cases')
+def test_report_table(name):
     df_suites = get_test_suites(name)
     if df_suites is not None:
         # print(df_suites.iloc[0, :])
@@ -247,5 +246,11 @@ def test_report_view(platform, label, name):
         cols = ["age", "status", "name", "T, s", "errorDetails"]
         suites_html = pd_to_html(df_suites, cols=cols, escape=True)
     else:
-        suites_html = ""
-    return render_template('test_report.html', platform=platform, label=label, name=name, suites_html=suites_html)
+        # report server error or no cases, not cached
+        suites_html = NoCache("")
+    return suites_html
+
+
+def test_report_view(platform, label, name):
+    return render_template('test_report.html', platform=platform, label=label, name=name,
+                           suites_html=test_report_table(name))
@@ -1,12 +1,17 @@
 # This source code is licensed under the Apache license found in the
 # LICENSE file in the root directory of this project.
 
+import functools
+import hashlib
 import logging
 
+from flask import Response, current_app, make_response, request, stream_with_context
 from flask_restplus import Api
 from server import settings
+from server.metrics import metrics
 from bson import json_util
 import json
+from urllib.parse import quote
 
 log = logging.getLogger(__name__)
 
@@ -24,9 +29,90 @@ def default_error_handler(e):
         return {'message': str(e)}, 500
 
 
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    """
+    Same as the flask_restplus json representation, with serialization timed
+    """
+    with metrics.serializing():
+        dumped = json.dumps(data, **current_app.config.get('RESTPLUS_JSON', {})) + "\n"
+    resp = make_response(dumped, code)
+    resp.headers.extend(headers or {})
+    return resp
+
+
+def conditional(*collection_names):
+    """
+    Strong ETag for GET resources built from the collections, derived from the collection
+    versions and the request path. A matching If-None-Match is answered with 304 without
+    running the resource.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not settings.ETAG_ENABLED:
+                return fn(*args, **kwargs)
+            from server.db.versions import get_versions
+            versions = get_versions(collection_names)
+            key = "{} {}".format(request.full_path, sorted(versions.items()))
+            etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+            if request.if_none_match.contains(etag):
+                resp = Response(status=304)
+                resp.set_etag(etag)
+                return resp
+            return add_etag(fn(*args, **kwargs), etag)
+        return wrapper
+    return decorator
+
+
+def add_etag(resp, etag):
+    """
+    Add ETag header to successful resource response
+    :param resp: response object, data or (data, code[, headers]) tuple
+    """
+    if isinstance(resp, Response):
+        if resp.status_code == 200:
+            resp.set_etag(etag)
+        return resp
+    if isinstance(resp, tuple):
+        data = resp[0]
+        code = len(resp) > 1 and resp[1] or 200
+        headers = len(resp) > 2 and dict(resp[2]) or dict()
+    else:
+        data, code, headers = resp, 200, dict()
+    if code == 200:
+        headers['ETag'] = '"{}"'.format(etag)
+    return data, code, headers
+
+
 def db_response_to_json(x):
-    json_str = json.dumps(x, default=json_util.default)
-    return json.loads(json_str)
+    with metrics.serializing():
+        json_str = json.dumps(x, default=json_util.default)
+        return json.loads(json_str)
+
+
+def stream_db_response(docs, fmt="json"):
+    """
+    Encode documents one by one while they are read from the cursor
+    :param docs: iterable of documents
+    :param fmt: "json" streams a json array, "ndjson" one json document per line
+    :return: chunked flask response
+    """
+    def generate_ndjson():
+        for doc in docs:
+            yield json.dumps(doc, default=json_util.default) + "\n"
+
+    def generate_json():
+        yield "["
+        sep = ""
+        for doc in docs:
+            yield sep + json.dumps(doc, default=json_util.default)
+            sep = ","
+        yield "]"
+
+    if fmt == "ndjson":
+        return Response(stream_with_context(generate_ndjson()), mimetype="application/x-ndjson")
+    return Response(stream_with_context(generate_json()), mimetype="application/json")
 
 
 def jenkins_response_to_json(x):
@@ -46,8 +132,90 @@ def insert_creds_to_jenkins_url(username, api_key, uri):
     return uri
 
 
-def create_jenkins_uri(username, api_key, uri):
+def create_jenkins_uri(username, api_key, uri, tree=None):
+    """
+    :param tree: jenkins tree expression selecting returned fields, e.g. "builds[number,url]"
+    """
     uri = insert_creds_to_jenkins_url(username, api_key, uri)
     if not uri.endswith('/'):
         uri = uri + '/'
-    return "{}api/json".format(uri)
+    uri = "{}api/json".format(uri)
+    if tree:
+        uri = "{}?tree={}".format(uri, quote(tree, safe=','))
+    return uri
+
+
+def jenkins_tree_range(tree, key, start, end):
+    """
+    Add range to array field of jenkins tree expression
+    jenkins_tree_range("name,builds[number,url]", "builds", 0, 100) -> "name,builds[number,url]{0,100}"
+    :param tree: tree expression
+    :param key: array field name
+    :param start: first item index
+    :param end: last item index (exclusive)
+    :return: tree expression, unchanged if there is no such array field
+    """
+    pos = 0
+    while True:
+        pos = tree.find(key + "[", pos)
+        if pos < 0:
+            return tree
+        if pos == 0 or tree[pos - 1] in ",[":
+            break
+        pos += 1
+    depth = 0
+    for i in range(pos + len(key), len(tree)):
+        if tree[i] == '[':
+            depth += 1
+        elif tree[i] == ']':
+            depth -= 1
+            if not depth:
+                return "{}{{{},{}}}{}".format(tree[:i + 1], start, end, tree[i + 1:])
+    return tree
+
+
+def merge_jenkins_page(data, page, key):
+    """
+    Append items of the arrays named key in page to the same arrays in data,
+    nested arrays are matched by position
+    :return: max number of items of an array named key in page
+    """
+    size = 0
+    if isinstance(data, dict) and isinstance(page, dict):
+        for k, v in page.items():
+            if k == key and isinstance(v, list):
+                data.setdefault(k, list()).extend(v)
+                size = max(size, len(v))
+            elif k in data:
+                size = max(size, merge_jenkins_page(data[k], v, key))
+    elif isinstance(data, list) and isinstance(page, list):
+        for x, y in zip(data, page):
+            size = max(size, merge_jenkins_page(x, y, key))
+    return size
+
+
+def jenkins_array_size(data, key):
+    """
+    :return: max number of items of an array named key in data
+    """
+    size = 0
+    if isinstance(data, dict):
+        for k, v in data.items():
+            if k == key and isinstance(v, list):
+                size = max(size, len(v))
+            else:
+                size = max(size, jenkins_array_size(v, key))
+    elif isinstance(data, list):
+        for x in data:
+            size = max(size, jenkins_array_size(x, key))
+    return size
+
+
+def job_build_numbers(data):
+    """
+    :param data: jenkins job data
+    :return: build numbers, newest first. allBuilds is only returned when requested with tree=,
+    builds is capped at the 100 newest builds by jenkins
+    """
+    builds = data.get('allBuilds') or data.get('builds') or list()
+    return [x['number'] for x in builds if x.get('number')]
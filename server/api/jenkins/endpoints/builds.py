@@ -6,10 +6,11 @@ from flask import request
 from flask_restplus import Resource
 import json
 
-from server.api.jenkins.parsers import get_data_args, get_artifacts_args, get_build_args
+from server.api.jenkins.parsers import get_data_args, get_artifacts_args, get_build_args, get_info_args
 from server.api.jenkins.serializers import build_schema
-from server.api.common import api, db_response_to_json
+from server.api.common import api, conditional, db_response_to_json, stream_db_response
 from server.db.models import JenkinsBuilds, JenkinsSites, JenkinsJobs
+from server.db.fetch_queue import get_info
 
 ns = api.namespace('jenkins/builds', description='Jenkins builds')
 log = logging.getLogger(__name__)
@@ -23,19 +24,13 @@ class BuildBase(Resource):
         super(BuildBase, self).__init__(api, args, kwargs)
 
     def url_to_name(self, uri):
-        uri = uri.rstrip('/')
-        parts = uri.split('/job/')
-        site = self.sites.get(url=parts[0])
-        site = site[0]
-        assert site, 'site was not found'
-        site_name = site['name']
-        parts = [site_name] + parts[1:-1] + parts[-1].split('/')
-        return ":".join(parts)
+        return self.sites.url_to_name(uri, split_last=True)
 
 
 @ns.route('/')
 class Builds(BuildBase):
 
+    @conditional('jenkins_builds', 'jenkins_data', 'jenkins_jobs')
     @api.expect(get_build_args)
     @api.marshal_list_with(build_schema)
     def get(self):
@@ -83,8 +78,11 @@ class Build(BuildBase):
 @ns.route('/<string:name>/info')
 @api.response(404, 'Build not found.')
 class BuildInfo(BuildBase):
+    @api.expect(get_info_args)
+    @api.response(202, 'Fetch queued.')
     def get(self, name):
-        return self.model.get_data(self.sites, name)
+        args = get_info_args.parse_args(request)
+        return get_info('builds', self.model, self.sites, name, wait=args.get('wait'))
 
 
 @ns.route('/<string:name>/artifacts')
@@ -105,6 +103,7 @@ class BuildArtifacts(BuildBase):
 @ns.route('/data')
 class BuildsData(BuildBase):
 
+    @conditional('jenkins_builds', 'jenkins_data')
     @api.expect(get_data_args)
     # @api.marshal_list_with(test_report_schema)
     def get(self):
@@ -112,6 +111,10 @@ class BuildsData(BuildBase):
         data_fields = args.get('data_fields', None)
         ts_from = args.get('ts_from', None)
         ts_to = args.get('ts_to', None)
+        stream = args.get('stream', None)
+        if stream:
+            resp = self.model.iter(data_fields=data_fields, ts_from=ts_from, ts_to=ts_to)
+            return stream_db_response(resp, fmt=stream)
         resp = self.model.get(data_fields=data_fields, ts_from=ts_from, ts_to=ts_to)
         log.info("Got {} records for test reports".format(len(resp)))
         return db_response_to_json(resp)
\ No newline at end of file
@@ -3,8 +3,7 @@
 
 from flask_restplus import Resource
 from server.api.common import api, db_response_to_json
-from server.db.models import JenkinsData
-import json
+from server.db.models import JenkinsData, decode_data_record, load_artifact_content
 
 ns = api.namespace('jenkins/data', description='Jenkins data for jobs, builds, test results')
 
@@ -28,8 +27,12 @@ class Data(DataBase):
     def get(self, doc_id):
         x = self.model.get_doc(doc_id=doc_id)
         if x:
-            x = db_response_to_json(x)
-            x['data'] = json.loads(x['data'])
+            x = {
+                "_id": db_response_to_json(x['_id']),
+                "data": decode_data_record(x)
+            }
+            if isinstance(x['data'], dict) and x['data'].get('gridfs_id'):
+                x['data']['content'] = load_artifact_content(x['data'])
         return x, x and 200 or 404
 
 
@@ -4,10 +4,11 @@
 from flask import request
 from flask_restplus import Resource
 
-from server.api.jenkins.parsers import get_jobs_args
+from server.api.jenkins.parsers import get_jobs_args, get_info_args
 from server.api.jenkins.serializers import job_schema
-from server.api.common import api, db_response_to_json
+from server.api.common import api, conditional, db_response_to_json
 from server.db.models import JenkinsJobs, JenkinsSites
+from server.db.fetch_queue import get_info
 
 
 ns = api.namespace('jenkins/jobs', description='Jenkins jobs')
@@ -20,19 +21,13 @@ class JobBase(Resource):
         super(JobBase, self).__init__(api, args, kwargs)
 
     def url_to_name(self, uri):
-        uri = uri.rstrip('/')
-        parts = uri.split('/job/')
-        site = self.sites.get(url=parts[0])
-        site = site[0]
-        assert site, 'site was not found'
-        site_name = site['name']
-        parts = [site_name] + parts[1:]
-        return ":".join(parts)
+        return self.sites.url_to_name(uri)
 
 
 @ns.route('/')
 class Jobs(JobBase):
 
+    @conditional('jenkins_jobs')
     @api.marshal_list_with(job_schema)
     def get(self):
         args = get_jobs_args.parse_args(request)
@@ -72,8 +67,11 @@ class Job(JobBase):
 @ns.route('/<string:name>/info')
 @api.response(404, 'Job not found.')
 class JobInfo(JobBase):
+    @api.expect(get_info_args)
+    @api.response(202, 'Fetch queued.')
     def get(self, name):
-        return self.model.get_data(self.sites, name)
+        args = get_info_args.parse_args(request)
+        return get_info('jobs', self.model, self.sites, name, wait=args.get('wait'))
 
 
 @ns.route('/<string:name>/builds')
@@ -86,6 +84,7 @@ class JobBuildNumbers(JobBase):
 @ns.route('/labels')
 @api.response(404, 'Labels not found.')
 class JobLabels(JobBase):
+    @conditional('jenkins_jobs')
     def get(self):
         x = self.model.get_jobs_labels()
         return db_response_to_json(x), x and 200 or 404
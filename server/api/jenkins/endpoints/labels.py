@@ -4,7 +4,7 @@
 from flask import request
 from flask_restplus import Resource
 from server.api.jenkins.serializers import label_schema
-from server.api.common import api, db_response_to_json
+from server.api.common import api, conditional, db_response_to_json
 from server.db.models import JenkinsLabels
 
 
@@ -20,6 +20,7 @@ class LabelBase(Resource):
 @ns.route('/')
 class Labels(LabelBase):
 
+    @conditional('jenkins_labels')
     # @api.marshal_list_with(job_schema)
     def get(self):
         return db_response_to_json(self.model.get_by_fields())
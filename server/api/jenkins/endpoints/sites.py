@@ -5,9 +5,11 @@ import logging
 
 from flask import request
 from flask_restplus import Resource
+from server.api.jenkins.parsers import get_info_args
 from server.api.jenkins.serializers import site_schema
-from server.api.common import api, db_response_to_json
+from server.api.common import api, conditional, db_response_to_json
 from server.db.models import JenkinsSites
+from server.db.fetch_queue import get_info
 
 log = logging.getLogger(__name__)
 
@@ -23,6 +25,7 @@ class SiteBase(Resource):
 @ns.route('/')
 class Sites(SiteBase):
 
+    @conditional('jenkins_sites')
     @api.marshal_list_with(site_schema)
     def get(self):
         log.info("getting sites")
@@ -60,6 +63,9 @@ class Site(SiteBase):
 @ns.route('/<string:name>/info')
 @api.response(404, 'Site not found.')
 class SiteInfo(SiteBase):
+    @api.expect(get_info_args)
+    @api.response(202, 'Fetch queued.')
     def get(self, name):
-        return self.model.get_site_data(name)
+        args = get_info_args.parse_args(request)
+        return get_info('sites', self.model, self.model, name, wait=args.get('wait'))
 
@@ -7,13 +7,18 @@ This should work only with internal database, no requests to jenkins should be m
 import logging
 from flask import request
 from flask_restplus import Resource
-from server.api.common import api, db_response_to_json
+from server.api.common import api, conditional, db_response_to_json, stream_db_response
+from server.api.jenkins_http import jenkins_http
+from server.db.cache import cache_stats
 from server.db.models import JenkinsSites, \
     JenkinsJobs, \
     JenkinsBuilds, \
     JenkinsTestReports, \
-    JenkinsLabels
-from server.api.jenkins.parsers import get_data_args
+    JenkinsLabels, \
+    JenkinsSummaries
+from server.api.jenkins.parsers import get_data_args, get_summary_args, get_version_args
+from server.db.fetch_queue import FetchQueue
+from server.db.versions import DATA_COLLECTIONS, data_version
 
 ns = api.namespace('reporter', description='Reporting server stats')
 log = logging.getLogger(__name__)
@@ -39,22 +44,112 @@ class Stats(ReporterBase):
             'test_reports': self.test_reports.get_count(),
             'data': self.sites.data_collection.count(),
             'labels': self.labels.get_count(),
-            'suites': self.test_reports.suites.get_count()
+            'suites': self.test_reports.suites.get_count(),
+            'jenkins_http': jenkins_http.stats(),
+            'cache': cache_stats(),
+            'fetch_queue': FetchQueue().stats()
         }
         return data, 200
 
 
 @ns.route('/tests')
 class Reporter(ReporterBase):
+    @conditional('jenkins_builds', 'jenkins_test_reports', 'jenkins_data')
     @api.expect(get_data_args)
     def get(self):
         args = get_data_args.parse_args(request)
         data_fields = args.get('data_fields', None)
         ts_from = args.get('ts_from', None)
         ts_to = args.get('ts_to', None)
+        stream = args.get('stream', None)
+        if stream:
+            builds = self.builds.iter(data_fields=data_fields, ts_from=ts_from, ts_to=ts_to)
+            resp = self.test_reports.iter_tests_from_builds(builds, test_data_fields=data_fields)
+            return stream_db_response(resp, fmt=stream)
         builds_resp = self.builds.get(data_fields=data_fields, ts_from=ts_from, ts_to=ts_to)
         log.info("Got {} records for test reports".format(len(builds_resp)))
         log.info("Getting test results corresponding to builds")
         resp = self.test_reports.get_tests_from_builds(builds_resp,
                                                        test_data_fields=data_fields)
         return db_response_to_json(resp)
+
+
+@ns.route('/summary')
+class Summary(ReporterBase):
+    @conditional('jenkins_summaries')
+    @api.expect(get_summary_args)
+    def get(self):
+        """
+        Test results of the latest test report of every job
+        """
+        args = get_summary_args.parse_args(request)
+        label = args.get('label', None)
+        return self.test_reports.summaries.get_summaries(label=label)
+
+    @api.response(201, "Summaries rebuilt.")
+    def post(self):
+        """
+        Rebuild summaries from stored test reports
+        """
+        num = self.test_reports.summaries.rebuild(self.test_reports)
+        return {"summaries": num}, 201
+
+
+@ns.route('/platform/<string:label>')
+class Platform(ReporterBase):
+    build_fields = ["branch", "job", "name", "url", "label", "number"]
+
+    @conditional('jenkins_jobs', 'jenkins_builds', 'jenkins_test_reports', 'jenkins_data')
+    def get(self, label):
+        """
+        Latest build of every (branch, job) of jobs with label, with its test results
+        """
+        jobs = self.jobs.get_jobs_by_label(label)
+        builds = self.builds.get_latest_by_branch([x['name'] for x in jobs],
+                                                  data_fields="timestamp,result,building")
+        builds = [b for b in builds if not b['data'].get('building')]
+        reports = self.test_reports.get_build_results(builds, ",".join(JenkinsSummaries.fields))
+        rows = list()
+        for build in builds:
+            row = dict((f, build.get(f)) for f in self.build_fields)
+            row['timestamp'] = build['data'].get('timestamp')
+            row['result'] = build['data'].get('result')
+            report = reports.get(build['name'])
+            row['test_report'] = report and report['name']
+            for f in JenkinsSummaries.fields:
+                row[f] = report and report['data'].get(f)
+            if report:
+                row['total'] = (report['data'].get('failCount') or 0) + (report['data'].get('passCount') or 0)
+            else:
+                row['total'] = None
+            rows.append(row)
+        return db_response_to_json(rows)
+
+
+@ns.route('/version')
+@api.response(400, 'Unknown collection.')
+class DataVersion(ReporterBase):
+    @api.expect(get_version_args)
+    def get(self):
+        """
+        Data version, changes whenever jenkins data is written to the collections, used by front-end caches
+        """
+        args = get_version_args.parse_args(request)
+        collections = args.get('collections')
+        collections = collections and collections.split(',') or DATA_COLLECTIONS
+        unknown = set(collections) - set(DATA_COLLECTIONS)
+        if unknown:
+            return {"message": "unknown collections: {}".format(", ".join(sorted(unknown)))}, 400
+        version, versions = data_version(collections)
+        return {"version": version, "collections": versions}, 200
+
+
+@ns.route('/queue/<string:ticket>')
+@api.response(404, 'Ticket not found.')
+class QueueTicket(ReporterBase):
+    def get(self, ticket):
+        """
+        Status of queued jenkins fetch
+        """
+        x = FetchQueue().status(ticket)
+        return x, x and 200 or 404
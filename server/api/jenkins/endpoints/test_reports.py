@@ -4,10 +4,11 @@
 import logging
 from flask import request
 from flask_restplus import Resource
-from server.api.jenkins.parsers import get_args, get_data_args, get_cases_args
+from server.api.jenkins.parsers import get_args, get_data_args, get_cases_args, get_info_args
 from server.api.jenkins.serializers import test_report_schema
-from server.api.common import api, db_response_to_json
+from server.api.common import api, conditional, db_response_to_json, stream_db_response
 from server.db.models import JenkinsTestReports, JenkinsSites
+from server.db.fetch_queue import get_info
 
 ns = api.namespace('jenkins/test_reports', description='Jenkins test reports')
 log = logging.getLogger(__name__)
@@ -20,19 +21,13 @@ class TestReportBase(Resource):
         super(TestReportBase, self).__init__(api, args, kwargs)
 
     def url_to_name(self, uri):
-        uri = uri.rstrip('/')
-        parts = uri.split('/job/')
-        site = self.sites.get(url=parts[0])
-        site = site[0]
-        assert site, 'site was not found'
-        site_name = site['name']
-        parts = [site_name] + parts[1:-1] + parts[-1].split('/')
-        return ":".join(parts)
+        return self.sites.url_to_name(uri, split_last=True)
 
 
 @ns.route('/')
 class TestReports(TestReportBase):
 
+    @conditional('jenkins_test_reports', 'jenkins_data')
     @api.expect(get_args)
     @api.marshal_list_with(test_report_schema)
     def get(self):
@@ -65,21 +60,22 @@ class TestReports(TestReportBase):
         """
         data = request.json
         data['name'] = self.url_to_name(data['url'])
-        names = data['name'].split(':')
-        data['job'] = ":".join(names[:-2])
-        data['build'] = names[-2]
-        rc = self.model.insert(data)
+        rc = self.model.insert_report(data)
         return None, rc and 201 or 200
 
 
 @ns.route('/data')
 class TestReportsData(TestReportBase):
 
+    @conditional('jenkins_test_reports', 'jenkins_data')
     @api.expect(get_data_args)
     # @api.marshal_list_with(test_report_schema)
     def get(self):
         args = get_data_args.parse_args(request)
         data_fields = args.get('data_fields', None)
+        stream = args.get('stream', None)
+        if stream:
+            return stream_db_response(self.model.iter(data_fields=data_fields), fmt=stream)
         resp = self.model.get(data_fields=data_fields)
         log.info("Got {} records for test reports".format(len(resp)))
         return db_response_to_json(resp)
@@ -112,9 +108,11 @@ class TestReportInfo(TestReportBase):
     """
     Test results are populated here
     """
+    @api.expect(get_info_args)
+    @api.response(202, 'Fetch queued.')
     def get(self, name):
-        data, rc = self.model.get_data(self.sites, name)
-        return data, rc
+        args = get_info_args.parse_args(request)
+        return get_info('test_reports', self.model, self.sites, name, wait=args.get('wait'))
 
 
 @ns.route('/<string:name>/suites')
@@ -134,6 +132,7 @@ class TestReportCases(TestReportBase):
     """
     Test results are populated here
     """
+    @conditional('jenkins_test_reports', 'jenkins_data', 'jenkins_suites', 'jenkins_cases')
     @api.expect(get_cases_args)
     def get(self, name):
         args = get_cases_args.parse_args(request)
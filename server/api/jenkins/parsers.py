@@ -42,6 +42,12 @@ get_data_args.add_argument('ts_to',
                            type=int,
                            required=False,
                            help="Timestamp to")
+get_data_args.add_argument('stream',
+                           type=str,
+                           required=False,
+                           default=None,
+                           choices=['json', 'ndjson'],
+                           help="Stream records as json array or newline delimited json")
 
 get_artifacts_args = reqparse.RequestParser()
 get_artifacts_args.add_argument('search',
@@ -75,3 +81,25 @@ get_cases_args.add_argument('cases_fields',
                             type=str,
                             required=False,
                             help="Get only specific fields for testcases")
+
+get_summary_args = reqparse.RequestParser()
+get_summary_args.add_argument('label',
+                              type=str,
+                              required=False,
+                              default=None,
+                              help="Get only summaries of jobs with label")
+
+get_version_args = reqparse.RequestParser()
+get_version_args.add_argument('collections',
+                              type=str,
+                              required=False,
+                              default=None,
+                              help="Comma separated collections the version is computed from, all if not set")
+
+get_info_args = reqparse.RequestParser()
+get_info_args.add_argument('wait',
+                           type=int,
+                           required=False,
+                           default=0,
+                           choices=[0, 1],
+                           help="Fetch from jenkins synchronously instead of queueing the fetch")
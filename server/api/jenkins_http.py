@@ -0,0 +1,123 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+Keep-alive connection pools to jenkins sites, shared by all model classes of the process
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from server import settings
+from server.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = int(round((len(values) - 1) * p / 100.0))
+    return values[k]
+
+
+class SiteSession(object):
+    """
+    requests session with connection pool and counters for one jenkins site
+    """
+    def __init__(self, name):
+        self.name = name
+        self.adapter = HTTPAdapter(pool_connections=settings.JENKINS_HTTP_POOL_CONNECTIONS,
+                                   pool_maxsize=settings.JENKINS_HTTP_POOL_MAXSIZE)
+        self.session = requests.Session()
+        self.session.verify = False
+        self.session.headers['Accept-Encoding'] = settings.JENKINS_HTTP_ACCEPT_ENCODING
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latencies = deque(maxlen=settings.JENKINS_HTTP_LATENCY_SAMPLES)
+
+    def get(self, uri, **kwargs):
+        kwargs.setdefault('timeout', settings.JENKINS_HTTP_TIMEOUT)
+        start = time.time()
+        try:
+            resp = self.session.get(uri, **kwargs)
+        except requests.RequestException:
+            with self.lock:
+                self.requests += 1
+                self.errors += 1
+            raise
+        elapsed = time.time() - start
+        # body of streamed responses is read later by the caller and not counted
+        num_bytes = 0 if kwargs.get('stream') else len(resp.content)
+        with self.lock:
+            self.requests += 1
+            if not resp.ok:
+                self.errors += 1
+            self.bytes += num_bytes
+            self.latencies.append(elapsed)
+        metrics.observe_jenkins(elapsed, num_bytes)
+        return resp
+
+    def connections_opened(self):
+        pools = self.adapter.poolmanager.pools
+        opened = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool:
+                opened += pool.num_connections
+        return opened
+
+    def stats(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            requests_count = self.requests
+            data = {
+                "requests": requests_count,
+                "errors": self.errors,
+                "bytes": self.bytes,
+            }
+        opened = self.connections_opened()
+        data["connections_opened"] = opened
+        data["connections_reused"] = max(requests_count - opened, 0)
+        data["latency_ms"] = dict(
+            ("p{}".format(p), latencies and round(1000 * percentile(latencies, p), 1))
+            for p in (50, 90, 99))
+        return data
+
+
+class JenkinsHttp(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sites = dict()
+
+    def site_session(self, site_name):
+        with self.lock:
+            if site_name not in self.sites:
+                log.info("Creating connection pool for jenkins site {}".format(site_name))
+                self.sites[site_name] = SiteSession(site_name)
+            return self.sites[site_name]
+
+    def get(self, site, uri, **kwargs):
+        """
+        :param site: jenkins site record
+        :param uri: full uri including credentials
+        :return: requests response
+        """
+        return self.site_session(site['name']).get(uri, **kwargs)
+
+    def stats(self):
+        with self.lock:
+            sites = list(self.sites.values())
+        return dict((x.name, x.stats()) for x in sites)
+
+
+jenkins_http = JenkinsHttp()
@@ -17,6 +17,10 @@ from server.api.jenkins.endpoints.sites import ns as jenkins_sites_namespace
 from server.api.jenkins.endpoints.stats import ns as jenkins_test_stats_namespace
 from server.api.jenkins.endpoints.test_reports import ns as jenkins_test_reports_namespace
 from server.db import db
+from server.db.indexes import ensure_indexes
+from server.db.fetch_queue import init_fetch_workers
+from server.metrics import init_metrics
+from server.profiler import init_profiler
 
 logging_conf_file = os.path.abspath("server/logging.conf")
 print(logging_conf_file)
@@ -36,8 +40,12 @@ def configure_app(flask_app):
     # flask_app.config['ERROR_404_HELP'] = settings.RESTPLUS_ERROR_404_HELP
 
 
-def initialize_app(flask_app):
+def initialize_app(flask_app, **config):
+    """
+    :param config: flask config overriding settings.py, e.g. MONGO_DBNAME of benchmarks
+    """
     configure_app(flask_app)
+    flask_app.config.update(config)
 
     blueprint = Blueprint('api', __name__, url_prefix='/api')
     api.init_app(blueprint)
@@ -50,7 +58,13 @@ def initialize_app(flask_app):
     api.add_namespace(jenkins_labels_namespace)
     flask_app.register_blueprint(blueprint)
 
+    init_metrics(flask_app)
+    init_profiler(flask_app)
+    init_fetch_workers(flask_app)
     db.init_app(flask_app)
+    if flask_app.config.get('MONGO_ENSURE_INDEXES', settings.MONGO_ENSURE_INDEXES):
+        with flask_app.app_context():
+            ensure_indexes(db.db)
 
 
 def reset_database(flask_app):
@@ -0,0 +1,454 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+Asyncio ingestion of jenkins builds and test reports, used by fetch_jenkins_info.py --async_ingest.
+Stores the same documents as the model classes, the Flask endpoints keep using the synchronous models.
+Needs aiohttp and motor:
+
+    pip install aiohttp motor
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+
+from bson.errors import InvalidDocument
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from server import settings
+from server.api.common import create_jenkins_uri, \
+    insert_creds_to_jenkins_url, \
+    jenkins_tree_range, \
+    jenkins_array_size, \
+    job_build_numbers, \
+    merge_jenkins_page
+from server.db.fetch_jenkins_info import LabelMatcher
+from server.db.cache import get_cache
+from server.db.models import JenkinsBuilds, JenkinsSummaries, JenkinsWatermarks, chunks
+from server.db.singleflight import claim_fields, expired_claim
+
+try:
+    import aiohttp
+    from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+except ImportError:
+    aiohttp = None
+    AsyncIOMotorClient = None
+    AsyncIOMotorGridFSBucket = None
+
+log = logging.getLogger(__name__)
+
+
+class AsyncJenkinsIngester(object):
+    def __init__(self, mongo_uri, dbname,
+                 site_concurrency=settings.INGEST_SITE_CONCURRENCY,
+                 max_in_flight=settings.ASYNC_INGEST_MAX_IN_FLIGHT,
+                 retries=settings.INGEST_RETRIES,
+                 backoff=settings.INGEST_RETRY_BACKOFF):
+        if aiohttp is None or AsyncIOMotorClient is None:
+            raise RuntimeError("async ingestion needs aiohttp and motor: pip install aiohttp motor")
+        self.client = AsyncIOMotorClient(mongo_uri)
+        self.db = self.client[dbname]
+        self.site_concurrency = site_concurrency
+        self.max_in_flight = max_in_flight
+        self.retries = retries
+        self.backoff = backoff
+        self.owner = "{}:{}:async".format(socket.gethostname(), os.getpid())
+        self.http = None
+        self.in_flight = None
+        self.site_semaphores = dict()
+        self.job_labels = dict()
+        self.matcher = None
+        # (build name, build info and test report fetched) for watermarks
+        self.ingested_builds = list()
+        self.completed_builds = list()
+        self.stats = dict((k, 0) for k in ("requests", "bytes", "retries", "failed",
+                                            "builds", "test_reports", "cases", "artifacts"))
+
+    async def get_json(self, site, uri, tree=None):
+        """
+        GET jenkins api/json with per site concurrency limit and retries
+        :return: (data, status)
+        """
+        url = create_jenkins_uri(site['username'], site['api_key'], uri, tree=tree)
+        semaphore = self.site_semaphores.setdefault(site['name'], asyncio.Semaphore(self.site_concurrency))
+        attempt = 0
+        while True:
+            try:
+                async with semaphore, self.in_flight:
+                    async with self.http.get(url) as resp:
+                        body = await resp.read()
+                        status = resp.status
+                self.stats['requests'] += 1
+                self.stats['bytes'] += len(body)
+                if status < 500 and status != 429:
+                    if 200 <= status < 300:
+                        return json.loads(body.decode('utf-8')), status
+                    log.error("GET {}: {}".format(uri, status))
+                    return None, status
+                error = "HTTP {}".format(status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            if attempt >= self.retries:
+                self.stats['failed'] += 1
+                log.error("GET {} failed after {} retries: {}".format(uri, attempt, error))
+                return None, 500
+            self.stats['retries'] += 1
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    async def get_resource(self, site, uri, resource_type):
+        """
+        Same as JenkinsBase._get_jenkins_url: tree query, paged arrays, running builds are skipped
+        """
+        tree = settings.JENKINS_TREE.get(resource_type)
+        paged_key = settings.JENKINS_TREE_PAGED.get(resource_type)
+        page_size = settings.JENKINS_TREE_PAGE_SIZE
+        if not tree or not paged_key or not page_size:
+            data, rc = await self.get_json(site, uri, tree)
+        else:
+            data, rc = await self.get_json(site, uri, jenkins_tree_range(tree, paged_key, 0, page_size))
+            size = jenkins_array_size(data, paged_key)
+            start = page_size
+            while data and size >= page_size:
+                page, rc = await self.get_json(site, uri, jenkins_tree_range(tree, paged_key, start, start + page_size))
+                if not page:
+                    data = None
+                    break
+                size = merge_jenkins_page(data, page, paged_key)
+                start += page_size
+        if data and data.get('building'):
+            data = None
+        return data, rc
+
+    async def changed(self, *collection_names):
+        """
+        Same as DbDocument.changed, called as writes land so the report server
+        doesn't serve stale ETags during a long run
+        """
+        for collection_name in collection_names:
+            cache = get_cache(collection_name)
+            if cache is not None:
+                cache.clear()
+            await self.db.jenkins_versions.update_one({"_id": collection_name},
+                                                      {"$inc": {"version": 1}},
+                                                      upsert=True)
+
+    async def insert_data(self, data):
+        if settings.JENKINS_DATA_NATIVE:
+            try:
+                return (await self.db.jenkins_data.insert_one({"payload": data})).inserted_id
+            except InvalidDocument:
+                pass
+        return (await self.db.jenkins_data.insert_one({"data": json.dumps(data)})).inserted_id
+
+    async def set_data(self, collection, doc, data):
+        """
+        Store data and point the document to it, previous data record is removed
+        """
+        rec_id = await self.insert_data(data)
+        await collection.update_one({"_id": doc['_id']}, {"$set": {"data": str(rec_id)}})
+        if doc.get('data'):
+            await self.db.jenkins_data.delete_one({"_id": ObjectId(doc['data'])})
+        await self.changed(self.db.jenkins_data.name, collection.name)
+
+    async def find_or_insert(self, collection, doc):
+        existing = await collection.find_one({"name": doc['name']})
+        if existing:
+            return existing
+        try:
+            await collection.insert_one(doc)
+            await self.changed(collection.name)
+        except DuplicateKeyError:
+            pass
+        return await collection.find_one({"name": doc['name']})
+
+    async def ingest_job(self, sites, job, build_limit=None, incremental=False, tests=True):
+        """
+        Failures are logged and counted, as phases of JenkinsFetcher do, other jobs go on
+        """
+        try:
+            await self.ingest_job_builds(sites[job['name'].split(':')[0]], job, build_limit, incremental, tests)
+        except Exception as e:
+            self.stats['failed'] += 1
+            log.exception("job {} failed: {}".format(job['name'], e))
+
+    async def ingest_job_builds(self, site, job, build_limit=None, incremental=False, tests=True):
+        data, rc = await self.get_resource(site, job['url'], 'job')
+        if not data:
+            return
+        await self.set_data(self.db.jenkins_jobs, job, data)
+        builds = job_build_numbers(data)
+        watermark = None
+        if incremental:
+            watermark = await self.db.jenkins_watermarks.find_one({"name": job['name']})
+            watermark = watermark and watermark['build'] or 0
+        builds = JenkinsWatermarks.select_builds(builds, watermark, build_limit)
+        await asyncio.gather(*[self.ingest_build(site, job, number, tests) for number in builds])
+
+    async def ingest_build(self, site, job, number, tests=True):
+        """
+        Failed builds and test reports are recorded as not ingested so that the watermark holds
+        """
+        name = "{}:{}".format(job['name'], number)
+        try:
+            ingested = await self.ingest_build_data(site, job, name, number, tests)
+        except Exception as e:
+            self.stats['failed'] += 1
+            log.exception("build {} failed: {}".format(name, e))
+            ingested = False
+        self.ingested_builds.append((name, ingested))
+
+    async def ingest_build_data(self, site, job, name, number, tests=True):
+        """
+        :return: True if build info and test report (if requested) are stored
+        """
+        url = "{}/{}".format(job['url'].rstrip('/'), number)
+        build = await self.find_or_insert(self.db.jenkins_builds, {"url": url, "name": name})
+        completed = bool(build.get('data'))
+        if not completed:
+            data, rc = await self.get_resource(site, url, 'build')
+            if data:
+                await self.set_data(self.db.jenkins_builds, build, data)
+                completed = True
+                self.stats['builds'] += 1
+                await self.ingest_artifacts(site, build, data)
+        ingested = completed
+        if completed:
+            self.completed_builds.append(name)
+            if tests:
+                ingested = await self.ingest_test_report(site, build)
+        return ingested
+
+    async def download_artifact(self, site, uri):
+        """
+        Same checks as JenkinsBuilds.download_artifact
+        :return: (content bytes, sha256 hex digest) or (None, None) if failed or too large
+        """
+        url = insert_creds_to_jenkins_url(site['username'], site['api_key'], uri)
+        semaphore = self.site_semaphores.setdefault(site['name'], asyncio.Semaphore(self.site_concurrency))
+        try:
+            async with semaphore, self.in_flight:
+                async with self.http.get(url) as resp:
+                    if resp.status != 200:
+                        log.error("can't download artifact {}: {}".format(uri, resp.status))
+                        return None, None
+                    if resp.content_length and resp.content_length > settings.ARTIFACT_MAX_BYTES:
+                        log.warning("SKIP artifact {}, {} bytes".format(uri, resp.content_length))
+                        return None, None
+                    sha = hashlib.sha256()
+                    parts = list()
+                    size = 0
+                    async for chunk in resp.content.iter_chunked(64 * 1024):
+                        size += len(chunk)
+                        if size > settings.ARTIFACT_MAX_BYTES:
+                            log.warning("SKIP artifact {}, more than {} bytes".format(
+                                uri, settings.ARTIFACT_MAX_BYTES))
+                            return None, None
+                        sha.update(chunk)
+                        parts.append(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.error("can't download artifact {}: {}".format(uri, e))
+            return None, None
+        self.stats['requests'] += 1
+        self.stats['bytes'] += size
+        return b"".join(parts), sha.hexdigest()
+
+    async def store_artifact(self, path, content, digest):
+        """
+        Same as JenkinsBuilds.store_artifact
+        :return: data record id or None if content is not json
+        """
+        existing = await self.db.jenkins_data.find_one({"sha256": digest, "artifact": path}, {"_id": 1})
+        if existing:
+            return existing['_id']
+        try:
+            d = json.loads(content.decode('utf-8'))
+        except ValueError as e:
+            log.error("artifact {} is not json: {}".format(path, e))
+            return None
+        if len(content) > settings.ARTIFACT_INLINE_MAX_BYTES:
+            bucket = AsyncIOMotorGridFSBucket(self.db, bucket_name='jenkins_artifacts')
+            file_id = await bucket.upload_from_stream(path, content, metadata={"sha256": digest})
+            data = {
+                "name": path,
+                "gridfs_id": str(file_id),
+                "size": len(content)
+            }
+        else:
+            data = {
+                "name": path,
+                "content": d
+            }
+        doc = {"sha256": digest, "artifact": path}
+        if settings.JENKINS_DATA_NATIVE:
+            doc['payload'] = data
+        else:
+            doc['data'] = json.dumps(data)
+        return (await self.db.jenkins_data.insert_one(doc)).inserted_id
+
+    async def ingest_artifacts(self, site, build, data):
+        """
+        Download artifacts used by BUILD_ARTIFACT_API labels,
+        labels phase afterwards finds them stored with the build
+        """
+        if not self.matcher or build.get('artifacts') or not data.get('artifacts'):
+            return
+        label = self.matcher.match(build['name'])
+        if not label or "BUILD_ARTIFACT_API" not in label['url']:
+            return
+        artifacts = JenkinsBuilds.filter_artifacts(data['artifacts'], label['artifact_pattern'])
+        downloads = await asyncio.gather(*[
+            self.download_artifact(site, "{}/artifact/{}".format(build['url'], art['relativePath']))
+            for art in artifacts], return_exceptions=True)
+        rec_ids = list()
+        for art, download in zip(artifacts, downloads):
+            if isinstance(download, Exception):
+                log.error("can't download artifact {} of {}: {}".format(art['relativePath'], build['name'], download))
+                continue
+            content, digest = download
+            if content is None:
+                continue
+            rec_id = await self.store_artifact(art['relativePath'], content, digest)
+            if rec_id:
+                rec_ids.append(str(rec_id))
+        if rec_ids:
+            await self.db.jenkins_builds.update_one({"_id": build['_id']}, {"$set": {"artifacts": rec_ids}})
+            await self.changed(self.db.jenkins_data.name, self.db.jenkins_builds.name)
+            self.stats['artifacts'] += len(rec_ids)
+
+    async def ingest_test_report(self, site, build):
+        """
+        :return: False if the report failed to be fetched or is fetched by another process,
+        so that the watermark doesn't move past the build
+        """
+        name = "{}:testReport".format(build['name'])
+        report = {
+            "url": "{}/testReport".format(build['url'].rstrip('/')),
+            "name": name,
+            "job": ":".join(build['name'].split(':')[:-1]),
+            "build": build['name'].split(':')[-1]
+        }
+        report = await self.find_or_insert(self.db.jenkins_test_reports, report)
+        if report.get('data'):
+            return True
+        # same claim as single-flight fetches of the report server
+        key = "jenkins_test_reports:{}".format(name)
+        fields = claim_fields(self.owner)
+        try:
+            await self.db.jenkins_fetch_claims.insert_one(dict(fields, _id=key))
+        except DuplicateKeyError:
+            # take over claim of a process that died while fetching
+            if await self.db.jenkins_fetch_claims.find_one_and_update(expired_claim(key),
+                                                                      {"$set": fields}) is None:
+                return False
+        try:
+            data, rc = await self.get_resource(site, report['url'], 'testReport')
+            if not data or not data.get('suites'):
+                # 4xx, e.g. builds without test report, won't succeed on later runs
+                return rc < 500
+            data['suites'] = await self.insert_suites(data['suites'])
+            await self.set_data(self.db.jenkins_test_reports, report, data)
+            summary = JenkinsSummaries.summary_document(report, self.job_labels.get(report['job']), data)
+            try:
+                await self.db.jenkins_summaries.update_one(
+                    {"job": report['job'], "build_number": {"$lt": summary['build_number']}},
+                    {"$set": summary},
+                    upsert=True)
+                await self.changed(self.db.jenkins_summaries.name)
+            except DuplicateKeyError:
+                pass
+            self.stats['test_reports'] += 1
+            return True
+        finally:
+            await self.db.jenkins_fetch_claims.delete_one({"_id": key, "owner": self.owner})
+
+    async def insert_many(self, collection, docs):
+        ids = list()
+        for docs_chunk in chunks(docs, settings.BULK_INSERT_CHUNK_SIZE):
+            ids.extend((await collection.insert_many(docs_chunk, ordered=True)).inserted_ids)
+        return ids
+
+    async def insert_suites(self, suites):
+        cases = list()
+        case_slices = list()
+        for suite in suites:
+            suite_cases = suite.get('cases') or list()
+            case_slices.append((len(cases), len(suite_cases)))
+            cases.extend(suite_cases)
+        case_ids = await self.insert_many(self.db.jenkins_cases, cases)
+        for suite, (offset, num_cases) in zip(suites, case_slices):
+            if suite.get('cases'):
+                suite['cases'] = case_ids[offset:offset + num_cases]
+        suite_ids = await self.insert_many(self.db.jenkins_suites, suites)
+        await self.changed(self.db.jenkins_cases.name, self.db.jenkins_suites.name)
+        self.stats['cases'] += len(case_ids)
+        return [str(x) for x in suite_ids]
+
+    async def commit_watermarks(self):
+        """
+        Same rule as JenkinsFetcher.commit_watermarks
+        """
+        watermarks = JenkinsWatermarks.new_watermarks(self.ingested_builds)
+        for job_name, watermark in watermarks.items():
+            await self.db.jenkins_watermarks.update_one({"name": job_name},
+                                                        {"$max": {"build": watermark}},
+                                                        upsert=True)
+
+    async def run(self, build_limit=None, incremental=False, tests=True):
+        """
+        Ingest builds (and test reports) of all jobs
+        :return: names of completed builds
+        """
+        start = time.time()
+        sites = dict()
+        async for site in self.db.jenkins_sites.find():
+            sites[site['name']] = site
+        jobs = list()
+        async for job in self.db.jenkins_jobs.find():
+            jobs.append(job)
+            self.job_labels[job['name']] = job.get('label')
+        labels = list()
+        async for label in self.db.jenkins_labels.find():
+            labels.append(label)
+        self.matcher = LabelMatcher(labels)
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        connector = aiohttp.TCPConnector(limit=self.max_in_flight, ssl=False)
+        timeout = aiohttp.ClientTimeout(sock_connect=settings.JENKINS_HTTP_TIMEOUT[0],
+                                        sock_read=settings.JENKINS_HTTP_TIMEOUT[1])
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as http:
+            self.http = http
+            await asyncio.gather(*[self.ingest_job(sites, job, build_limit, incremental, tests)
+                                   for job in jobs])
+        if tests:
+            await self.commit_watermarks()
+        self.elapsed = time.time() - start
+        return self.completed_builds
+
+    def summary(self):
+        return ("async: {builds} builds, {test_reports} test reports, {cases} cases, "
+                "{artifacts} artifacts in {elapsed:.1f}s "
+                "({rate:.1f} builds/s), {requests} requests, {bytes} bytes, "
+                "{retries} retries, {failed} failed").format(elapsed=self.elapsed,
+                                                             rate=self.stats['builds'] / max(self.elapsed, 1e-6),
+                                                             **self.stats)
+
+
+def run_async_ingest(build_limit=None, incremental=False, tests=True,
+                     mongo_uri=settings.MONGO_URI, dbname=settings.MONGO_DBNAME):
+    """
+    :return: (names of completed builds, ingester)
+    """
+    ingester = AsyncJenkinsIngester(mongo_uri, dbname)
+    loop = asyncio.new_event_loop()
+    try:
+        build_names = loop.run_until_complete(ingester.run(build_limit=build_limit,
+                                                           incremental=incremental,
+                                                           tests=tests))
+    finally:
+        loop.close()
+    return build_names, ingester
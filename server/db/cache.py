@@ -0,0 +1,82 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+In-process read-through cache for small, rarely changing collections.
+Entries expire after the collection TTL, writes through the model classes clear the collection cache.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from server import settings
+
+
+class LRUCache(object):
+    def __init__(self, name, ttl, maxsize):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        :return: (found, value)
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry:
+                del self.entries[key]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+
+caches = dict()
+caches_lock = threading.Lock()
+
+
+def get_cache(collection_name):
+    """
+    :return: cache of the collection or None if the collection is not cached
+    """
+    ttl = settings.CACHE_TTL.get(collection_name)
+    if not ttl:
+        return None
+    with caches_lock:
+        if collection_name not in caches:
+            caches[collection_name] = LRUCache(collection_name, ttl, settings.CACHE_MAX_ENTRIES)
+        return caches[collection_name]
+
+
+def cache_stats():
+    with caches_lock:
+        return dict((name, cache.stats()) for name, cache in caches.items())
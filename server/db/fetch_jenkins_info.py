@@ -2,11 +2,15 @@
 # LICENSE file in the root directory of this project.
 
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pymongo import MongoClient
 import requests
-import json
 from server.settings import *
+from server.api.jenkins_http import jenkins_http
+from server.db.models import JenkinsSites, JenkinsJobs, JenkinsBuilds, \
+    JenkinsTestReports, JenkinsLabels, JenkinsWatermarks, load_artifact_content
 import argparse
 import os.path
 import urllib3
@@ -29,208 +33,479 @@ def get_label_for_build(labels, build_name):
     return None
 
 
+# patterns referring to their own groups can't be combined into one regex
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+
+class LabelMatcher(object):
+    """
+    Same result as get_label_for_build, but all build name patterns are compiled once
+    into a single regex: one branch per label in labels order, the first branch
+    with a pattern found in the build name wins.
+    Falls back to precompiled patterns tried one by one if the patterns can't be combined.
+    """
+    def __init__(self, labels):
+        self.labels = labels
+        self.parsers = dict()
+        self.lock = threading.Lock()
+        self.builds = 0
+        self.matched = 0
+        self.elapsed = 0.0
+        self.combined = None
+        self.compiled = list()
+        branches = list()
+        for i, label in enumerate(labels):
+            patterns = [str(p) for p in label['build_name_patterns']]
+            self.compiled.append([re.compile(p) for p in patterns])
+            if patterns:
+                alternatives = "|".join("(?:{})".format(p) for p in patterns)
+                branches.append("(?=[\\s\\S]*?(?:{}))(?P<label{}>)".format(alternatives, i))
+        if branches and not any(BACKREFERENCE.search(str(p)) for label in labels
+                                for p in label['build_name_patterns']):
+            try:
+                self.combined = re.compile("(?:{})".format("|".join(branches)))
+            except re.error as e:
+                print("Can't combine label patterns, matching one by one: {}".format(e))
+
+    def _match(self, build_name):
+        if self.combined:
+            m = self.combined.match(build_name)
+            if m:
+                return self.labels[int(m.lastgroup[len("label"):])]
+            return None
+        for label, patterns in zip(self.labels, self.compiled):
+            for pattern in patterns:
+                if pattern.search(build_name):
+                    return label
+        return None
+
+    def match(self, build_name):
+        """
+        :return: label to apply or None
+        """
+        start = time.time()
+        label = self._match(build_name)
+        elapsed = time.time() - start
+        with self.lock:
+            self.builds += 1
+            self.elapsed += elapsed
+            if label:
+                self.matched += 1
+        return label
+
+    def parser(self, label):
+        """
+        :return: compiled label parser
+        """
+        with self.lock:
+            if label['name'] not in self.parsers:
+                self.parsers[label['name']] = eval(label['parser'])
+            return self.parsers[label['name']]
+
+    def summary(self):
+        return "labels: {} builds matched of {} ({:.1f}%), {:.1f}us per build, {}".format(
+            self.matched, self.builds,
+            100.0 * self.matched / max(self.builds, 1),
+            1e6 * self.elapsed / max(self.builds, 1),
+            self.combined and "combined regex" or "patterns one by one")
+
+
 def drop_db(client, name):
     print("DROP", name)
     client.drop_database(name)
 
 
-def populate_db(db, fname, server_url):
+def populate_db(sites, jobs, labels, fname):
     """
     Populate DB from file
-    :param db: 
+    :param sites: JenkinsSites model
+    :param jobs: JenkinsJobs model
+    :param labels: JenkinsLabels model
+    :param fname: data file
     :return: 
     """
     print("Populating DB with sites and jobs from file {}".format(fname))
     assert os.path.isfile(fname), "data file is not found"
     data = eval(open(fname, 'r').read())
 
-    sites = data['sites']
-    for site in sites:
-        if db.jenkins_sites.find_one({"name": site['name']}):
-            continue
-        else:
-            rec_id = db.jenkins_sites.insert_one(site).inserted_id
+    for site in data['sites']:
+        sites.insert(site)
 
-    jobs = data['jobs']
-    for job in jobs:
-        if db.jenkins_jobs.find_one({"url": job['url']}):
+    for job in data['jobs']:
+        if jobs.get_by_fields(url=job['url']):
             continue
-        else:
-            uri = "{}/jobs/".format(server_url)
-            resp = requests.post(uri, json=job)
-            assert resp.ok, "can't post jenkins job to the report server"
-            # rec_id = db.jenkins_jobs.insert_one(job).inserted_id
+        job['name'] = sites.url_to_name(job['url'])
+        jobs.insert(job)
 
-    labels = data['labels']
-    for label in labels:
-        if db.jenkins_labels.find_one({"name": label['name']}):
-            continue
-        else:
-            rec_id = db.jenkins_labels.insert_one(label).inserted_id
+    for label in data['labels']:
+        labels.insert(label)
     print("Done")
 
 
+class PhaseStats(object):
+    """
+    Progress and throughput of one ingestion phase
+    """
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.retries = 0
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.last_report = self.start
+        self.elapsed = None
+
+    def add(self, ok=True):
+        with self.lock:
+            self.done += 1
+            if not ok:
+                self.failed += 1
+            now = time.time()
+            if now - self.last_report >= INGEST_PROGRESS_INTERVAL:
+                self.last_report = now
+                print("{}: {}/{} ({:.1f}%) {:.1f} items/s".format(
+                    self.name, self.done, self.total,
+                    100.0 * self.done / max(self.total, 1),
+                    self.done / (now - self.start)))
+
+    def add_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def finish(self):
+        self.elapsed = time.time() - self.start
+
+    def summary(self):
+        return "{:<14} {:>7} {:>7} {:>7} {:>9.1f} {:>9.1f}".format(
+            self.name, self.done, self.failed, self.retries, self.elapsed,
+            self.done / max(self.elapsed, 1e-6))
+
+
 class JenkinsFetcher(object):
-    def __init__(self, database, api_url):
-        self.db = database
-        self.api_url = api_url
+    """
+    Fetches jenkins info through the model layer,
+    jenkins requests are spread over a pool of workers with a concurrency limit per jenkins site
+    """
+    def __init__(self, app,
+                 workers=INGEST_WORKERS,
+                 site_concurrency=INGEST_SITE_CONCURRENCY,
+                 retries=INGEST_RETRIES,
+                 backoff=INGEST_RETRY_BACKOFF):
+        self.app = app
+        self.workers = workers
+        self.site_concurrency = site_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.site_semaphores = dict()
+        self.site_semaphores_lock = threading.Lock()
+        self.stats = list()
+        self.phase_stats = None
+        self.label_matcher = None
+        # (build name, build info and test report fetched) of builds ingested in this run
+        self.ingested_builds = list()
+        with app.app_context():
+            self.sites = JenkinsSites()
+            self.jobs = JenkinsJobs()
+            self.builds = JenkinsBuilds()
+            self.test_reports = JenkinsTestReports()
+            self.labels = JenkinsLabels()
+            self.watermarks = JenkinsWatermarks()
+
+    def site_semaphore(self, name):
+        site_name = name.split(':')[0]
+        with self.site_semaphores_lock:
+            if site_name not in self.site_semaphores:
+                self.site_semaphores[site_name] = threading.BoundedSemaphore(self.site_concurrency)
+            return self.site_semaphores[site_name]
+
+    def call_jenkins(self, name, fn, *args):
+        """
+        Call model method which fetches from jenkins, retry with exponential backoff
+        on connection errors and 5xx/429 responses
+        :param name: name of the site, job, build or report, used for concurrency limit per site
+        :param fn: model method returning (data, status_code)
+        :return: data
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.site_semaphore(name):
+                    data, rc = fn(*args)
+                if rc < 500 and rc != 429:
+                    return data
+                error = "HTTP {}".format(rc)
+            except requests.RequestException as e:
+                error = e
+            if attempt >= self.retries:
+                raise RuntimeError("{} failed after {} retries: {}".format(name, attempt, error))
+            delay = self.backoff * 2 ** attempt
+            print("RETRY {} in {:.1f}s: {}".format(name, delay, error))
+            self.phase_stats.add_retry()
+            time.sleep(delay)
+            attempt += 1
+
+    def run_phase(self, phase, items, fn):
+        """
+        Run fn for every item on the worker pool
+        :return: list of results of items that succeeded
+        """
+        stats = PhaseStats(phase, len(items))
+        self.stats.append(stats)
+        self.phase_stats = stats
+        print("{}: {} items".format(phase, len(items)))
+
+        def task(item):
+            with self.app.app_context():
+                return fn(item)
+
+        results = list()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = dict((pool.submit(task, item), item) for item in items)
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                    stats.add()
+                except Exception as e:
+                    stats.add(ok=False)
+                    item = futures[future]
+                    if isinstance(item, dict):
+                        item = item.get('name')
+                    print("{} FAILED {}: {}".format(phase, item, e))
+        stats.finish()
+        return results
 
     def fetch_sites(self):
-        sites = self.db.jenkins_sites.find()
-        for site in sites:
-            print("FS: SITE", site)
-            uri = "{}/sites/{}/info".format(self.api_url, site['name'])
-            resp = requests.get(uri)
-            assert resp.ok, "jenkins site is not reachable {}".format(uri)
+        sites = self.sites.get()
+        self.run_phase("sites", sites,
+                       lambda site: self.call_jenkins(site['name'], self.sites.get_site_data, site['name']))
 
     def update_jenkins_jobs_data(self):
-        print("Updating data on jenkins jobs")
-        uri = "{}/jobs?fetch_data".format(self.api_url)
-        resp = requests.get(uri)
-        assert resp.ok
+        jobs = self.jobs.get()
+        self.run_phase("jobs", jobs, self.refresh_job_data)
 
-    def fetch_builds(self, build_limit=None):
-        self.update_jenkins_jobs_data()
-        print("Getting jenkins builds")
-        jobs = self.db.jenkins_jobs.find()
+    def refresh_job_data(self, job):
+        data = self.call_jenkins(job['name'], self.jobs.fetch_data, self.sites, job)
+        if data:
+            if job.get('data'):
+                self.jobs.replace_data_in_doc(job, data)
+            else:
+                self.jobs.add_data_to_doc(job, data)
 
-        # get builds for each job
+    def insert_job_builds(self, job, build_limit=None, incremental=False):
+        builds = self.call_jenkins(job['name'], self.jobs.get_builds, self.sites, job['name'])
+        watermark = self.watermarks.get_watermark(job['name']) if incremental else None
+        builds = self.watermarks.select_builds(builds, watermark, build_limit)
         build_names = list()
-        for job in jobs:
-            print("FB JOB:", job)
-            uri = "{}/jobs/{}/builds".format(self.api_url, job['name'])
-            resp = requests.get(uri)
-            builds = json.loads(resp.text)
-            if build_limit:
-                builds = builds[:int(build_limit)]
-            for build in builds:
-                bld_url = job['url'].rstrip('/')
-                bld_url = "{}/{}".format(bld_url, build)
-                # print("BLD_URL:", bld_url)
-                uri = "{}/builds/".format(self.api_url)
-                data = {
-                    "url": bld_url
-                }
-                resp = requests.post(uri, json=data)
-                assert resp.ok, "error getting build info from jenkins"
-                name = json.loads(resp.text)['name']
-                build_names.append(name)
-
-        # fetch build info
-        for build_name in build_names:
-            build = self.db.jenkins_builds.find_one({"name": build_name})
-            print("FB BUILD", build)
-            uri = "{}/builds/{}/info".format(self.api_url, build['name'])
-            resp = requests.get(uri)
-            assert resp.ok, "can't fetch build data"
-
-    def apply_labels_to_builds(self):
-        # fetch build labels
-        uri = "{}/labels".format(self.api_url)
-        resp = requests.get(uri)
-        labels = json.loads(resp.text)
-        builds = self.db.jenkins_builds.find()
         for build in builds:
-            if build.get('label') and build['label'] != "null":
-                continue
-            label = get_label_for_build(labels, build['name'])
-            if label:
-                parser = eval(label['parser'])
-                print("APPLY LABEL", label['name'], "BUILD", build['name'])
-                label_data = None
-                if "BUILD_INFO_API" == label['url']:
-                    uri = "{}/builds/{}/info".format(self.api_url, build['name'])
-                    resp = requests.get(uri)
-                    if resp.ok:
-                        label_data = json.loads(resp.text)
-                elif "BUILD_ARTIFACT_API" in label['url']:
-                    artifact_pattern = label['artifact_pattern']
-                    uri = "{}/builds/{}/artifacts?search=".format(self.api_url, build['name'])
-                    uri = "{}{}".format(uri, artifact_pattern)
-                    print("ARTIFACT URL", uri)
-                    resp = requests.get(uri)
-                    if resp.ok:
-                        data_ids = json.loads(resp.text)
-                        if data_ids:
-                            uri = "{}/data/{}".format(self.api_url, data_ids[0])
-                            resp = requests.get(uri)
-                            f_content = json.loads(resp.text)['data']
-                            label_data = f_content['content']
-
-                            print(f_content)
-                build = self.db.jenkins_builds.find_one({"name": build['name']})
-                if label_data:
-                    l = parser(label_data)
-                    print("Extracted label", l)
-                    build[u'label'] = l
-                    print("UPDATING", build['name'])
-                    self.db.jenkins_builds.save(build)
-            pass
-
-    def fetch_test_results(self):
-        print("Getting jenkins test results")
-        builds = self.db.jenkins_builds.find()
+            bld_url = job['url'].rstrip('/')
+            bld_url = "{}/{}".format(bld_url, build)
+            name = "{}:{}".format(job['name'], build)
+            self.builds.insert({"url": bld_url, "name": name})
+            build_names.append(name)
+        return build_names
+
+    def fetch_build_info(self, name):
+        data = self.call_jenkins(name, self.builds.get_data, self.sites, name)
+        # builds still running have no data
+        return name, data is not None
+
+    def fetch_builds(self, build_limit=None, incremental=False):
+        """
+        :param build_limit: max number of builds per job
+        :param incremental: fetch only builds newer than the job watermark
+        :return: names of completed builds
+        """
+        self.update_jenkins_jobs_data()
+        jobs = self.jobs.get()
+        results = self.run_phase("job builds", jobs,
+                                 lambda job: self.insert_job_builds(job, build_limit, incremental))
+        build_names = [name for names in results for name in names]
+        completed = self.run_phase("builds", build_names, self.fetch_build_info)
+        completed = set(name for name, ok in completed if ok)
+        self.ingested_builds = [(name, name in completed) for name in build_names]
+        return [name for name in build_names if name in completed]
+
+    def commit_watermarks(self):
+        """
+        Move job watermarks to the highest build number below the first build
+        that is still running or whose build info or test report failed to be fetched
+        """
+        watermarks = self.watermarks.new_watermarks(self.ingested_builds)
+        for job_name, watermark in watermarks.items():
+            self.watermarks.set_watermark(job_name, watermark)
+        print("Updated watermarks of {} jobs".format(len(watermarks)))
+
+    def get_artifact_content(self, build_name, artifact_pattern):
+        data = self.call_jenkins(build_name, self.builds.get_data, self.sites, build_name)
+        if not data or not data.get('artifacts'):
+            return None
+        artifacts = self.builds.filter_artifacts(data['artifacts'], artifact_pattern)
+        with self.site_semaphore(build_name):
+            data_ids = self.builds.get_artifacts(self.sites, build_name, artifacts)
+        if not data_ids:
+            return None
+        return load_artifact_content(self.builds.get_data_records([data_ids[0]])[0])
+
+    def apply_label(self, matcher, build):
+        label = matcher.match(build['name'])
+        if not label:
+            return None
+        parser = matcher.parser(label)
+        label_data = None
+        if "BUILD_INFO_API" == label['url']:
+            label_data = self.call_jenkins(build['name'], self.builds.get_data, self.sites, build['name'])
+        elif "BUILD_ARTIFACT_API" in label['url']:
+            label_data = self.get_artifact_content(build['name'], label['artifact_pattern'])
+        if not label_data:
+            return None
+        l = parser(label_data)
+        self.builds.update(build['name'], {u'label': l})
+        return l
+
+    def apply_labels_to_builds(self, build_names=None):
+        labels = self.labels.get_by_fields()
+        if build_names is None:
+            builds = self.builds.get()
+        else:
+            builds = self.builds.get_by_names(build_names)
+        builds = [b for b in builds if not b.get('label') or b['label'] == "null"]
+        self.label_matcher = LabelMatcher(labels)
+        self.run_phase("labels", builds, lambda build: self.apply_label(self.label_matcher, build))
+
+    def fetch_test_results(self, build_names=None):
+        """
+        :param build_names: fetch test results only for these builds
+        """
+        if build_names is None:
+            builds = self.builds.get()
+        else:
+            builds = self.builds.get_by_names(build_names)
 
         # create test records
+        report_names = list()
         for build in builds:
-            print("FT BUILD:", build)
             test_url = build['url'].rstrip('/')
             test_url = "{}/testReport".format(test_url)
-            uri = "{}/test_reports/".format(self.api_url)
-            data = {
-                "url": test_url
-            }
-            resp = requests.post(uri, json=data)
-            assert resp.ok, "can't fetch test report metadata"
+            name = "{}:testReport".format(build['name'])
+            self.test_reports.insert_report({"url": test_url, "name": name})
+            report_names.append(name)
 
         # populate with test results
-        reports = self.db.jenkins_test_reports.find()
-        for report in reports:
-            print("FT REPORT", report)
-            uri = "{}/test_reports/{}/info".format(self.api_url, report['name'])
-            print("GET {}".format(uri))
-            resp = requests.get(uri)
-            if not resp.ok:
-                print("TR_ERROR", "can't fetch test report")
+        if build_names is None:
+            reports = self.test_reports.get_reports(data=False)
+        else:
+            reports = self.test_reports.get_by_names(report_names)
+            reports = self.test_reports.filter_by_data(reports, with_data=False)
+
+        def fetch_report(report):
+            self.call_jenkins(report['name'], self.test_reports.get_data, self.sites, report['name'])
+            return report['name']
+
+        fetched = self.run_phase("test reports", reports, fetch_report)
+        # builds whose test report failed are fetched again by the next incremental run
+        failed = set(r['name'] for r in reports) - set(fetched)
+        self.ingested_builds = [(name, ingested and "{}:testReport".format(name) not in failed)
+                                for name, ingested in self.ingested_builds]
+
+    def print_summary(self):
+        print("{:<14} {:>7} {:>7} {:>7} {:>9} {:>9}".format(
+            "phase", "items", "failed", "retries", "time, s", "items/s"))
+        for stats in self.stats:
+            print(stats.summary())
+        if self.label_matcher:
+            print(self.label_matcher.summary())
+        for site_name, stats in jenkins_http.stats().items():
+            print("jenkins {}: {} requests, {} connections opened, {} reused, "
+                  "{} bytes, latency ms {}".format(site_name,
+                                                    stats['requests'],
+                                                    stats['connections_opened'],
+                                                    stats['connections_reused'],
+                                                    stats['bytes'],
+                                                    stats['latency_ms']))
+
+
+def ingest(app, data_file, get_builds=False, get_tests=False, build_limit=None, incremental=False,
+           async_ingest=False, workers=INGEST_WORKERS, site_concurrency=INGEST_SITE_CONCURRENCY):
+    """
+    Populate DB from data file and fetch jenkins info
+    :return: JenkinsFetcher with the stats of the run
+    """
+    jf = JenkinsFetcher(app,
+                        workers=workers,
+                        site_concurrency=site_concurrency)
+    with app.app_context():
+        # populate with sites and jobs from .data file
+        populate_db(jf.sites, jf.jobs, jf.labels, data_file)
+
+        # fetch jenkins info and store in DB
+        jf.fetch_sites()
+        build_names = None
+        if async_ingest and get_builds:
+            from server.db.async_ingest import run_async_ingest
+            build_names, ingester = run_async_ingest(build_limit=build_limit,
+                                                     incremental=incremental,
+                                                     tests=bool(get_tests),
+                                                     mongo_uri=app.config['MONGO_URI'],
+                                                     dbname=app.config['MONGO_DBNAME'])
+            print(ingester.summary())
+            jf.apply_labels_to_builds(build_names=build_names if incremental else None)
+        elif get_builds:
+            build_names = jf.fetch_builds(build_limit=build_limit,
+                                          incremental=incremental)
+            if not incremental:
+                build_names = None
+            jf.apply_labels_to_builds(build_names=build_names)
+        # async ingestion fetches test reports of the builds it ingests,
+        # test reports of stored builds (-T without -B) are fetched by the worker pool
+        if get_tests and not (async_ingest and get_builds):
+            jf.fetch_test_results(build_names=build_names)
+        # watermarks move only when test reports were fetched too, builds ingested
+        # without their test report are selected again by the next incremental run
+        if get_builds and get_tests and not async_ingest:
+            jf.commit_watermarks()
+    return jf
 
 
 def main():
-    client = MongoClient()
     if args.drop_db:
+        client = MongoClient()
         drop_db(client, MONGO_DBNAME)
         return
 
-    db = client.reporting
-    # populate with sites and jobs from .data file
-    start = time.time()
-    server_url = "http://{}:{}/api/jenkins".format(args.host, args.port)
-    populate_db(db, args.data_file, server_url)
+    from server.app import app, initialize_app
+    initialize_app(app)
 
-    # fetch jenkins info and store in DB
-    jf = JenkinsFetcher(db, server_url)
-    jf.fetch_sites()
-    if args.get_builds:
-        jf.fetch_builds(build_limit=args.build_limit)
-        jf.apply_labels_to_builds()
-    if args.get_tests:
-        jf.fetch_test_results()
-    print("Populating DB takes {}s".format(time.time() - start))
+    start = time.time()
+    jf = ingest(app, args.data_file,
+                get_builds=args.get_builds,
+                get_tests=args.get_tests,
+                build_limit=args.build_limit,
+                incremental=args.incremental,
+                async_ingest=args.async_ingest,
+                workers=args.workers,
+                site_concurrency=args.site_concurrency)
+    jf.print_summary()
+    print("Populating DB takes {:.1f}s".format(time.time() - start))
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-H", "--host",
-                        help="report server host",
-                        default="localhost")
-    parser.add_argument("-P", "--port",
-                        help="report server port",
-                        default="5001")
     parser.add_argument("-F", "--data_file",
                         help="data file to pre populate DB",
                         default="server/db/.data")
     parser.add_argument("-L", "--build_limit",
                         default=None,
                         help="limit the number of builds to fetch from jenkins for each job")
+    parser.add_argument("-W", "--workers",
+                        type=int,
+                        default=INGEST_WORKERS,
+                        help="number of concurrent workers")
+    parser.add_argument("-C", "--site_concurrency",
+                        type=int,
+                        default=INGEST_SITE_CONCURRENCY,
+                        help="max number of concurrent requests to one jenkins site")
     parser.add_argument('-D', '--drop_db',
                         required=False,
                         default=False,
@@ -245,6 +520,13 @@ if __name__ == "__main__":
                         const='True',
                         help='Get jenkins builds'
                         )
+    parser.add_argument('-I', '--incremental',
+                        required=False,
+                        default=False,
+                        action='store_true',
+                        help='Get only builds newer than the last ingested build of each job, '
+                             'watermarks are updated by runs with -B -T'
+                        )
     parser.add_argument('-T', '--get_tests',
                         required=False,
                         default=False,
@@ -252,5 +534,11 @@ if __name__ == "__main__":
                         const='True',
                         help='Get jenkins test reports'
                         )
+    parser.add_argument('-A', '--async_ingest',
+                        required=False,
+                        default=False,
+                        action='store_true',
+                        help='Get builds and test reports with asyncio (needs aiohttp and motor)'
+                        )
     args = parser.parse_args()
     main()
@@ -0,0 +1,201 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+Persistent queue of jenkins /info fetches, served by background workers of the report server.
+One ticket per document, a ticket that is pending or running is not queued again.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from server import settings
+from server.db import db
+from server.db.models import JenkinsSites, JenkinsJobs, JenkinsBuilds, JenkinsTestReports
+
+log = logging.getLogger(__name__)
+
+QUEUE_MODELS = {
+    'sites': JenkinsSites,
+    'jobs': JenkinsJobs,
+    'builds': JenkinsBuilds,
+    'test_reports': JenkinsTestReports,
+}
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class FetchQueue(object):
+    def __init__(self):
+        self.collection = db.db.jenkins_fetch_queue
+
+    def enqueue(self, kind, name):
+        """
+        :param kind: key of QUEUE_MODELS
+        :param name: document name
+        :return: ticket
+        """
+        ticket = "{}:{}".format(kind, name)
+        try:
+            self.collection.update_one({"_id": ticket, "state": {"$nin": [PENDING, RUNNING]}},
+                                       {"$set": {"kind": kind,
+                                                 "name": name,
+                                                 "state": PENDING,
+                                                 "created": time.time(),
+                                                 "attempts": 0,
+                                                 "not_before": 0,
+                                                 "error": None}},
+                                       upsert=True)
+        except DuplicateKeyError:
+            # already in flight
+            pass
+        return self.status(ticket)
+
+    def claim(self, worker_id):
+        """
+        Atomically take the oldest pending ticket due for a retry, or a running one whose worker timed out
+        """
+        now = time.time()
+        query = {"$or": [{"state": PENDING, "not_before": {"$not": {"$gt": now}}},
+                         {"state": RUNNING, "claimed": {"$lt": now - settings.FETCH_QUEUE_CLAIM_TIMEOUT}}]}
+        return self.collection.find_one_and_update(query,
+                                                   {"$set": {"state": RUNNING,
+                                                             "claimed": now,
+                                                             "worker": worker_id},
+                                                    "$inc": {"attempts": 1}},
+                                                   sort=[("created", 1)],
+                                                   return_document=ReturnDocument.AFTER)
+
+    def complete(self, ticket, rc, error=None):
+        """
+        Failed fetches are retried with exponential backoff, except 4xx other than 429
+        which won't succeed on a retry, e.g. 404 of a deleted build
+        """
+        now = time.time()
+        not_before = 0
+        if rc < 400:
+            state = DONE
+        elif rc < 500 and rc != 429 or ticket['attempts'] >= settings.FETCH_QUEUE_MAX_ATTEMPTS:
+            state = FAILED
+        else:
+            state = PENDING
+            not_before = now + settings.FETCH_QUEUE_RETRY_BACKOFF * 2 ** (ticket['attempts'] - 1)
+        self.collection.update_one({"_id": ticket['_id'], "worker": ticket['worker']},
+                                   {"$set": {"state": state,
+                                             "rc": rc,
+                                             "error": error,
+                                             "not_before": not_before,
+                                             "finished": now}})
+
+    def status(self, ticket):
+        return self.collection.find_one({"_id": ticket})
+
+    def stats(self):
+        res = dict((state, 0) for state in (PENDING, RUNNING, DONE, FAILED))
+        for x in self.collection.aggregate([{"$group": {"_id": "$state", "count": {"$sum": 1}}}]):
+            res[x['_id']] = x['count']
+        return res
+
+
+def fetch(kind, name):
+    """
+    Fetch document data from jenkins and store it
+    :return: (data, rc)
+    """
+    sites = JenkinsSites()
+    if kind == 'sites':
+        return sites.get_site_data(name)
+    model = QUEUE_MODELS[kind]()
+    return model.get_data(sites, name)
+
+
+def get_info(kind, model, sites, name, wait=False):
+    """
+    Data of the document from DB, on a miss the fetch is queued and a ticket is returned with 202
+    :param kind: key of QUEUE_MODELS
+    :param model: model of the document
+    :param sites: JenkinsSites model
+    :param name: document name
+    :param wait: fetch synchronously on a miss
+    :return: (data, rc)
+    """
+    if not settings.FETCH_QUEUE_ENABLED or wait:
+        return fetch(kind, name)
+    data, rc = model.get_cached_data(name)
+    if data or rc != 200:
+        return data, rc
+    ticket = FetchQueue().enqueue(kind, name)
+    return {"ticket": ticket['_id'], "state": ticket['state']}, 202
+
+
+class FetchWorkers(object):
+    def __init__(self, app, num_workers):
+        self.app = app
+        self.num_workers = num_workers
+        self.stopped = threading.Event()
+        self.threads = list()
+
+    def start(self):
+        for i in range(self.num_workers):
+            worker_id = "{}:{}:{}".format(socket.gethostname(), os.getpid(), i)
+            t = threading.Thread(target=self.run, args=(worker_id,), name="fetch-worker-{}".format(i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        log.info("Started {} fetch workers".format(self.num_workers))
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self, worker_id):
+        with self.app.app_context():
+            queue = FetchQueue()
+            while not self.stopped.is_set():
+                try:
+                    ticket = queue.claim(worker_id)
+                except Exception as e:
+                    log.exception(e)
+                    ticket = None
+                if not ticket:
+                    self.stopped.wait(settings.FETCH_QUEUE_POLL_INTERVAL)
+                    continue
+                try:
+                    _, rc = fetch(ticket['kind'], ticket['name'])
+                    queue.complete(ticket, rc)
+                except Exception as e:
+                    log.exception(e)
+                    queue.complete(ticket, 500, error=str(e))
+
+
+def start_fetch_workers(app):
+    if not settings.FETCH_QUEUE_ENABLED or not settings.FETCH_QUEUE_WORKERS:
+        return None
+    workers = FetchWorkers(app, settings.FETCH_QUEUE_WORKERS)
+    workers.start()
+    return workers
+
+
+def init_fetch_workers(flask_app):
+    """
+    Start fetch workers with the first request served by the process, so that they also run
+    in every process of WSGI servers (after gunicorn/uwsgi fork their workers),
+    but not in CLIs that only initialize the app, e.g. fetch_jenkins_info.py
+    """
+    lock = threading.Lock()
+    started = list()
+
+    @flask_app.before_request
+    def start_workers():
+        if started:
+            return
+        with lock:
+            if not started:
+                started.append(start_fetch_workers(flask_app))
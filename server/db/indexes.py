@@ -0,0 +1,202 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+Indexes of the report server collections, created at server startup.
+Audit existing indexes and query plans of the hot queries:
+
+    python server/db/indexes.py
+    python server/db/indexes.py --create
+"""
+import argparse
+import logging
+
+from pymongo import MongoClient, IndexModel, ASCENDING, DESCENDING
+from pymongo.collation import Collation
+from pymongo.errors import OperationFailure
+
+log = logging.getLogger(__name__)
+
+INDEXES = {
+    'jenkins_sites': [
+        IndexModel([('name', ASCENDING)], unique=True),
+        IndexModel([('url', ASCENDING)]),
+    ],
+    'jenkins_jobs': [
+        IndexModel([('name', ASCENDING)], unique=True),
+        IndexModel([('url', ASCENDING)]),
+        IndexModel([('label', ASCENDING)]),
+    ],
+    'jenkins_builds': [
+        IndexModel([('name', ASCENDING)], unique=True),
+        IndexModel([('url', ASCENDING)]),
+        IndexModel([('label', ASCENDING)]),
+    ],
+    'jenkins_test_reports': [
+        IndexModel([('name', ASCENDING)], unique=True),
+        # same collation as queries sorting by build number
+        IndexModel([('job', ASCENDING), ('build', DESCENDING)], unique=True,
+                   collation=Collation(locale="en", numericOrdering=True),
+                   name="job_1_build_-1_numeric"),
+    ],
+    # suites and cases are inserted with duplicates allowed
+    'jenkins_suites': [
+        IndexModel([('name', ASCENDING)]),
+    ],
+    'jenkins_cases': [
+        IndexModel([('name', ASCENDING)]),
+    ],
+    'jenkins_labels': [
+        IndexModel([('name', ASCENDING)], unique=True),
+    ],
+    'jenkins_summaries': [
+        IndexModel([('job', ASCENDING)], unique=True),
+        IndexModel([('label', ASCENDING)]),
+    ],
+    'jenkins_fetch_queue': [
+        IndexModel([('state', ASCENDING), ('created', ASCENDING)]),
+    ],
+    # claims are released after the fetch, claims never released are removed by mongo
+    'jenkins_fetch_claims': [
+        IndexModel([('expires_at', ASCENDING)], expireAfterSeconds=0),
+    ],
+    'jenkins_watermarks': [
+        IndexModel([('name', ASCENDING)], unique=True),
+    ],
+    'jenkins_data': [
+        IndexModel([('payload.timestamp', ASCENDING)]),
+        IndexModel([('sha256', ASCENDING), ('artifact', ASCENDING)], sparse=True),
+    ],
+}
+
+# (collection, filter, sort) of the queries served on every request or ingestion step
+HOT_QUERIES = [
+    ('jenkins_sites', {'name': ''}, None),
+    ('jenkins_sites', {'url': ''}, None),
+    ('jenkins_jobs', {'name': ''}, None),
+    ('jenkins_jobs', {'url': ''}, None),
+    ('jenkins_jobs', {'label': ''}, None),
+    ('jenkins_builds', {'name': ''}, None),
+    ('jenkins_test_reports', {'name': ''}, None),
+    ('jenkins_test_reports', {}, [('job', ASCENDING), ('build', DESCENDING)]),
+    ('jenkins_labels', {'name': ''}, None),
+    ('jenkins_data', {'payload.timestamp': {'$gte': 0}}, None),
+]
+
+
+def ensure_indexes(database):
+    """
+    Create missing indexes, existing indexes are left untouched
+    :param database: pymongo database
+    :return: list of (collection, index name, error) for indexes that couldn't be created
+    """
+    failed = list()
+    for collection_name, indexes in INDEXES.items():
+        collection = database[collection_name]
+        for index in indexes:
+            try:
+                collection.create_indexes([index])
+            except OperationFailure as e:
+                # e.g. duplicated values for unique index
+                name = index.document['name']
+                log.error("can't create index {} on {}: {}".format(name, collection_name, e))
+                failed.append((collection_name, name, str(e)))
+    return failed
+
+
+def same_collation(collation, existing_collation):
+    """
+    :param collation: collation of the index definition, None for simple binary comparison
+    :param existing_collation: collation reported by index_information(), it lists all collation options
+    """
+    if not collation:
+        return not existing_collation or existing_collation.get('locale') == 'simple'
+    if not existing_collation:
+        return False
+    return all(existing_collation.get(k) == v for k, v in collation.items())
+
+
+def missing_indexes(database):
+    """
+    An index with the same keys but another collation doesn't count,
+    queries use only indexes of their own collation
+    :param database: pymongo database
+    :return: list of (collection, index name, index keys) defined in INDEXES but missing in the database
+    """
+    missing = list()
+    for collection_name, indexes in INDEXES.items():
+        existing = database[collection_name].index_information().values()
+        for index in indexes:
+            keys = list(index.document['key'].items())
+            collation = index.document.get('collation')
+            if not any(list(x['key']) == keys and same_collation(collation, x.get('collation'))
+                       for x in existing):
+                missing.append((collection_name, index.document['name'], keys))
+    return missing
+
+
+def plan_stages(plan):
+    """
+    :param plan: winning plan from explain() output
+    :return: list of stages from the root, e.g. ['FETCH', 'IXSCAN']
+    """
+    stages = list()
+    while plan:
+        stages.append(plan.get('stage'))
+        plan = plan.get('inputStage') or (plan.get('inputStages') or [None])[0]
+    return stages
+
+
+def explain_hot_queries(database):
+    """
+    :param database: pymongo database
+    :return: list of (collection, filter, sort, stages)
+    """
+    res = list()
+    for collection_name, query, sort in HOT_QUERIES:
+        cursor = database[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort).collation(Collation(locale="en", numericOrdering=True))
+        explain = cursor.explain()
+        stages = plan_stages(explain['queryPlanner']['winningPlan'])
+        res.append((collection_name, query, sort, stages))
+    return res
+
+
+def main():
+    client = MongoClient()
+    database = client[args.db_name]
+    if args.create:
+        failed = ensure_indexes(database)
+        print("Created indexes, {} failed".format(len(failed)))
+        for x in failed:
+            print("FAILED", x)
+
+    missing = missing_indexes(database)
+    print("Missing indexes: {}".format(len(missing)))
+    for collection_name, name, keys in missing:
+        print("  {}: {} {}".format(collection_name, name, keys))
+
+    print("Query plans:")
+    for collection_name, query, sort, stages in explain_hot_queries(database):
+        scan = "COLLSCAN" in stages and "FULL SCAN" or "ok"
+        print("  {:<8} {}.find({}){}: {}".format(scan,
+                                                collection_name,
+                                                query,
+                                                sort and ".sort({})".format(sort) or "",
+                                                " <- ".join(stages)))
+
+
+if __name__ == "__main__":
+    from server.settings import MONGO_DBNAME
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--db_name",
+                        help="database name",
+                        default=MONGO_DBNAME)
+    parser.add_argument('-c', '--create',
+                        required=False,
+                        default=False,
+                        action='store_true',
+                        help='create missing indexes')
+    args = parser.parse_args()
+    main()
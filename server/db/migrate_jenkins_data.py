@@ -0,0 +1,108 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+Convert jenkins_data records stored as json strings to native BSON subdocuments
+
+    python server/db/migrate_jenkins_data.py
+"""
+import argparse
+import json
+import logging
+import time
+
+from bson.errors import InvalidDocument
+from pymongo import MongoClient, UpdateOne, ASCENDING
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from server.settings import MONGO_DBNAME
+
+log = logging.getLogger(__name__)
+
+
+def migrate(collection, batch_size, dry_run=False):
+    """
+    :return: (number of converted records, ids of records kept as json strings)
+    """
+    query = {"data": {"$type": "string"}}
+    print("{} legacy records to convert".format(collection.count(query)))
+    converted = 0
+    skipped = list()
+    ids = list()
+    ops = list()
+    for record in collection.find(query):
+        payload = json.loads(record['data'])
+        ids.append(record['_id'])
+        ops.append(UpdateOne({"_id": record['_id'], "data": record['data']},
+                             {"$set": {"payload": payload}, "$unset": {"data": ""}}))
+        if len(ops) >= batch_size:
+            c, s = write_batch(collection, ids, ops, dry_run)
+            converted, skipped = converted + c, skipped + s
+            print("converted {} records".format(converted))
+            ids = list()
+            ops = list()
+    if ops:
+        c, s = write_batch(collection, ids, ops, dry_run)
+        converted, skipped = converted + c, skipped + s
+    return converted, skipped
+
+
+def write_batch(collection, ids, ops, dry_run):
+    """
+    Records whose payload can't be stored natively, e.g. keys with '.' or '$',
+    are rejected by the server and stay json strings
+    :param ids: record ids of ops
+    :return: (number of converted records, ids of records kept as json strings)
+    """
+    if dry_run:
+        return len(ops), list()
+    try:
+        result = collection.bulk_write(ops, ordered=False)
+        return result.modified_count, list()
+    except BulkWriteError as e:
+        # unordered bulk write applies all other ops
+        skipped = list()
+        for error in e.details['writeErrors']:
+            log.warning("record {} kept as json string: {}".format(ids[error['index']], error['errmsg']))
+            skipped.append(ids[error['index']])
+        return e.details['nModified'], skipped
+    except InvalidDocument:
+        # rejected client side, no op was sent, retry one by one
+        pass
+    converted = 0
+    skipped = list()
+    for i in range(len(ops)):
+        try:
+            converted += collection.bulk_write([ops[i]]).modified_count
+        except (BulkWriteError, InvalidDocument, OperationFailure) as e:
+            log.warning("record {} kept as json string: {}".format(ids[i], e))
+            skipped.append(ids[i])
+    return converted, skipped
+
+
+def main():
+    client = MongoClient()
+    db = client[MONGO_DBNAME]
+    start = time.time()
+    converted, skipped = migrate(db.jenkins_data, args.batch_size, dry_run=args.dry_run)
+    if not args.dry_run:
+        db.jenkins_data.create_index([("payload.timestamp", ASCENDING)])
+    print("Converted {} records, kept {} as json strings in {:.1f}s".format(
+        converted, len(skipped), time.time() - start))
+    for rec_id in skipped:
+        print("kept as json string: {}".format(rec_id))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b", "--batch_size",
+                        type=int,
+                        default=500,
+                        help="number of records per bulk write")
+    parser.add_argument('-n', '--dry_run',
+                        required=False,
+                        default=False,
+                        action='store_true',
+                        help='only count records to convert')
+    args = parser.parse_args()
+    main()
@@ -1,16 +1,32 @@
 # This source code is licensed under the Apache license found in the
 # LICENSE file in the root directory of this project.
 
-import requests
+import copy
+import hashlib
 import json
+from concurrent.futures import ThreadPoolExecutor
+from bson.errors import InvalidDocument
 from bson.objectid import ObjectId
+import gridfs
+from pymongo.errors import DuplicateKeyError
+from pymongo.collation import Collation
 import logging
 import re
+import time
 
+from server import settings
 from server.db import db
+from server.db.cache import get_cache
+from server.db.versions import bump_version
+from server.db.singleflight import single_flight
+from server.api.jenkins_http import jenkins_http
 from server.api.common import jenkins_response_to_json, \
     create_jenkins_uri, \
     insert_creds_to_jenkins_url, \
+    jenkins_tree_range, \
+    jenkins_array_size, \
+    job_build_numbers, \
+    merge_jenkins_page, \
     db_response_to_json
 import urllib3
 urllib3.disable_warnings()
@@ -18,6 +34,125 @@ urllib3.disable_warnings()
 log = logging.getLogger(__name__)
 
 
+def agg_join(array, sep):
+    """
+    Aggregation expression joining an array of strings with sep
+    """
+    return {"$reduce": {"input": array,
+                        "initialValue": None,
+                        "in": {"$cond": [{"$eq": ["$$value", None]},
+                                         "$$this",
+                                         {"$concat": ["$$value", sep, "$$this"]}]}}}
+
+
+# test report build numbers are stored as strings, compare them as numbers
+BUILD_NUMBER_COLLATION = Collation(locale="en", numericOrdering=True)
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def iter_chunks(iterable, size):
+    """
+    Like chunks but for iterators, e.g. mongo cursors
+    """
+    chunk = list()
+    for x in iterable:
+        chunk.append(x)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+def find_by_ids(collection, ids, query=None, projection=None):
+    """
+    Find documents by ids with chunked $in queries
+    :param collection: pymongo collection
+    :param ids: list of ids, either ObjectId or string
+    :param query: additional query predicate
+    :param projection: mongo projection
+    :return: dict of id (as string) to document
+    """
+    object_ids = list(set(ObjectId(x) for x in ids))
+    res = dict()
+    for ids_chunk in chunks(object_ids, settings.DATA_RECORDS_CHUNK_SIZE):
+        q = {"_id": {"$in": ids_chunk}}
+        if query:
+            q.update(query)
+        for r in collection.find(q, projection):
+            res[str(r['_id'])] = r
+    return res
+
+
+def data_record_has_data(record):
+    """
+    :param record: jenkins_data record, payload is either native (payload) or json string (data)
+    :return: True if record holds non null jenkins data
+    """
+    if not record:
+        return False
+    if 'payload' in record:
+        return record['payload'] is not None
+    return 'data' in record and record['data'] != 'null'
+
+
+def decode_data_record(record):
+    if 'payload' in record:
+        return record['payload']
+    return json.loads(record['data'])
+
+
+def artifacts_fs():
+    return gridfs.GridFS(db.db, collection='jenkins_artifacts')
+
+
+def load_artifact_content(artifact):
+    """
+    :param artifact: decoded artifact data record, {name: <path>, content: <json>}
+                     or {name: <path>, gridfs_id: <id>} for artifacts stored in GridFS
+    :return: artifact content
+    """
+    if artifact.get('gridfs_id'):
+        f = artifacts_fs().get(ObjectId(artifact['gridfs_id']))
+        return json.loads(f.read().decode('utf-8'))
+    return artifact['content']
+
+
+def data_fields_projection(data_fields):
+    """
+    Mongo projection for jenkins_data records,
+    legacy json string records are always returned as a whole
+    :param data_fields: comma separated list of fields or "*"
+    :return: projection or None for all fields
+    """
+    if not data_fields or data_fields == "*":
+        return None
+    projection = {"data": 1}
+    for f in data_fields.split(','):
+        projection["payload.{}".format(f)] = 1
+    return projection
+
+
+def timestamp_query(ts_from=None, ts_to=None):
+    """
+    Timestamp window predicate for jenkins_data records,
+    legacy json string records are matched unconditionally and filtered after decoding
+    """
+    ts = dict()
+    if ts_from:
+        ts["$gte"] = ts_from
+    if ts_to:
+        ts["$lte"] = ts_to
+    if not ts:
+        return None
+    return {"$or": [{"data": {"$type": "string"}},
+                    {"payload.timestamp": ts}]}
+
+
 class DbDocument(object):
     collection = None
 
@@ -34,6 +169,32 @@ class DbDocument(object):
         return resp
 
     def get_by_fields(self, **kwargs):
+        cache = get_cache(self.collection.name)
+        if cache is None:
+            docs = self.iter_by_fields(**kwargs)
+            docs = list(docs)
+            return docs
+        key = tuple(sorted((k, v) for k, v in kwargs.items() if v))
+        found, docs = cache.get(key)
+        if not found:
+            docs = list(self.iter_by_fields(**kwargs))
+            cache.set(key, docs)
+        # callers modify returned documents
+        return copy.deepcopy(docs)
+
+    def changed(self):
+        """
+        Called after every write, clears cached reads and bumps collection version
+        """
+        cache = get_cache(self.collection.name)
+        if cache is not None:
+            cache.clear()
+        bump_version(self.collection.name)
+
+    def iter_by_fields(self, **kwargs):
+        """
+        Same as get_by_fields, but returns mongo cursor
+        """
         query = dict()
         if kwargs:
             name = kwargs.get('name')
@@ -49,9 +210,25 @@ class DbDocument(object):
             docs = self.collection.find(query)
         else:
             docs = self.collection.find()
-        docs = list(docs)
         return docs
 
+    def get_by_names(self, names):
+        """
+        Get documents by names with chunked $in queries
+        :param names: list of document names
+        :return: list of documents, order is not preserved
+        """
+        docs = list()
+        for names_chunk in chunks(list(names), settings.DATA_RECORDS_CHUNK_SIZE):
+            docs.extend(self.collection.find({"name": {"$in": names_chunk}}))
+        return docs
+
+    def get_docs_by_ids(self, doc_ids, projection=None):
+        """
+        :return: dict of document id (as string) to document
+        """
+        return find_by_ids(self.collection, doc_ids, projection=projection)
+
     def get_count(self):
         return self.collection.count()
 
@@ -62,15 +239,40 @@ class DbDocument(object):
         :param allow_duplicates: 
         :return: 
         """
-        if self.collection.count({'name': data['name']}) and not allow_duplicates:
+        if not allow_duplicates and self.collection.count({'name': data['name']}):
             return False
         else:
-            rec_id = self.collection.insert_one(data).inserted_id
+            try:
+                rec_id = self.collection.insert_one(data).inserted_id
+                self.changed()
+            except DuplicateKeyError:
+                # concurrent insert won the race on the unique index
+                return False
             assert rec_id, "entry was not created"
             return rec_id
 
+    def insert_many(self, documents, allow_duplicates=None):
+        """
+        Insert documents with ordered insert_many in chunks
+        :param documents: list of documents
+        :param allow_duplicates: if not set, documents with existing names are skipped
+        :return: list of inserted ids
+        """
+        documents = list(documents)
+        if not allow_duplicates:
+            existing = set(x['name'] for x in self.get_by_names([x['name'] for x in documents]))
+            documents = [x for x in documents if x['name'] not in existing]
+        rec_ids = list()
+        for docs_chunk in chunks(documents, settings.BULK_INSERT_CHUNK_SIZE):
+            rec_ids.extend(self.collection.insert_many(docs_chunk, ordered=True).inserted_ids)
+        if rec_ids:
+            self.changed()
+        assert len(rec_ids) == len(documents), "entries were not created"
+        return rec_ids
+
     def remove_by_name(self, name):
         resp = self.collection.remove({"name": name})
+        self.changed()
         assert resp['n'] > 0, "can't delete document {}".format(name)
         return True
 
@@ -85,8 +287,67 @@ class JenkinsLabels(DbDocument):
         self.collection = db.db.jenkins_labels
 
 
+class JenkinsWatermarks(DbDocument):
+    """
+    Highest build number ingested per job, used by incremental ingestion
+    """
+    def __init__(self):
+        self.collection = db.db.jenkins_watermarks
+
+    def get_watermark(self, job_name):
+        doc = self.collection.find_one({"name": job_name})
+        return doc and doc['build'] or 0
+
+    def get_watermarks(self):
+        return dict((x['name'], x['build']) for x in self.collection.find())
+
+    def set_watermark(self, job_name, build):
+        """
+        Watermark never moves back
+        """
+        self.collection.update_one({"name": job_name},
+                                   {"$max": {"build": build}},
+                                   upsert=True)
+
+    @staticmethod
+    def select_builds(builds, watermark=None, build_limit=None):
+        """
+        :param builds: build numbers of a job, newest first as listed by jenkins
+        :param watermark: keep only builds above the watermark, None keeps all builds
+        :param build_limit: max number of builds, the newest ones without watermark,
+        the oldest ones above the watermark otherwise, so that moving the watermark never skips builds
+        """
+        if watermark is not None:
+            builds = sorted(b for b in builds if b > watermark)
+        if build_limit:
+            builds = builds[:int(build_limit)]
+        return builds
+
+    @staticmethod
+    def new_watermarks(ingested_builds):
+        """
+        :param ingested_builds: (build name, ingested) of builds selected in a run,
+        ingested is False for builds still running or failed to be fetched, including their test report
+        :return: dict of job name to the highest build number below the first build not ingested
+        """
+        jobs = dict()
+        for name, ingested in ingested_builds:
+            job_name, number = name.rsplit(':', 1)
+            jobs.setdefault(job_name, list()).append((int(number), ingested))
+        watermarks = dict()
+        for job_name, builds in jobs.items():
+            incomplete = [number for number, ingested in builds if not ingested]
+            if incomplete:
+                watermarks[job_name] = min(incomplete) - 1
+            else:
+                watermarks[job_name] = max(number for number, _ in builds)
+        return watermarks
+
+
 class JenkinsBase(DbDocument):
     data_collection = None
+    # key of settings.JENKINS_TREE
+    resource_type = None
 
     def __init__(self):
         self.data_collection = db.db.jenkins_data
@@ -95,46 +356,85 @@ class JenkinsBase(DbDocument):
         data_id = document.get('data')
         if data_id:
             resp = self.get_data_record(data_id)
-            if resp['data'] != 'null':
+            if data_record_has_data(resp):
                 return True
         return False
 
+    def filter_by_data(self, documents, with_data=True):
+        """
+        Batched version of has_data
+        :param documents: list of documents
+        :param with_data: keep documents with data if True, without data otherwise
+        :return: filtered list of documents
+        """
+        query = {"$or": [{"payload": {"$type": "object"}},
+                         {"data": {"$type": "string", "$ne": "null"}}]}
+        records = self.get_data_records_by_ids([doc['data'] for doc in documents if doc.get('data')],
+                                               query=query,
+                                               projection={"_id": 1})
+        res = list()
+        for doc in documents:
+            has_data = str(doc.get('data')) in records
+            if has_data == bool(with_data):
+                res.append(doc)
+        return res
+
     def populate_data(self, documents, data_fields, ts_from=None, ts_to=None):
+        # builds not completed don't have 'data' field reference
+        documents = [doc for doc in documents if doc.get('data')]
+        records = self.get_data_records_by_ids([doc['data'] for doc in documents],
+                                               query=timestamp_query(ts_from, ts_to),
+                                               projection=data_fields_projection(data_fields))
         r = list()
         for doc in documents:
-            # builds not completed don't have 'data' field reference
-            if doc.get('data'):
-                x = self.get_data_record(doc['data'])
-                if x.get('data') != 'null':
-                    x = x['data']
-                    x = json.loads(x)
-                    d = dict()
-                    if data_fields == "*":
-                        d = x
-                    else:
-                        fields = data_fields.split(',')
-                        for f in fields:
-                            if f in x.keys():
-                                d[f] = x[f]
-                    doc['data'] = d
-                    append_this = True
+            x = records.get(str(doc['data']))
+            if not x:
+                # either outside of timestamp window or missing
+                continue
+            if data_record_has_data(x):
+                legacy = 'payload' not in x
+                x = decode_data_record(x)
+                d = dict()
+                if data_fields == "*":
+                    d = x
+                else:
+                    fields = data_fields.split(',')
+                    for f in fields:
+                        if f in x.keys():
+                            d[f] = x[f]
+                doc['data'] = d
+                append_this = True
+                if legacy:
+                    # native records are filtered by the query
                     if ts_from and ts_from > x['timestamp']:
                         append_this = False
                     if ts_to and ts_to < x['timestamp']:
                         append_this = False
-                    if append_this:
-                        r.append(doc)
+                if append_this:
+                    r.append(doc)
         return r
 
     def get(self, name=None, url=None, data=None, data_fields=None, ts_from=None, ts_to=None):
         res = self.get_by_fields(name=name, url=url)
         if data:
-            res = [r for r in res if self.has_data(r)]
+            res = self.filter_by_data(res)
         if data_fields:
             # populate and filter data
             res = self.populate_data(res, data_fields, ts_from=ts_from, ts_to=ts_to)
         return res
 
+    def iter(self, name=None, url=None, data_fields=None, ts_from=None, ts_to=None):
+        """
+        Streaming version of get, documents are read from the cursor and populated
+        with data chunk by chunk, so memory doesn't grow with the number of documents
+        """
+        docs = self.iter_by_fields(name=name, url=url)
+        for docs_chunk in iter_chunks(docs, settings.DATA_RECORDS_CHUNK_SIZE):
+            if data_fields:
+                docs_chunk = self.populate_data(docs_chunk, data_fields, ts_from=ts_from, ts_to=ts_to)
+            for doc in docs_chunk:
+                yield doc
+
     def remove(self, name):
         return self.remove_by_name(name)
 
@@ -146,11 +446,27 @@ class JenkinsBase(DbDocument):
         for k, v in data.items():
             document[k] = v
         self.collection.save(document)
+        self.changed()
         return True
 
-    def insert_data(self, data):
-        db_resp = self.data_collection.insert_one({"data": json.dumps(data)})
-        rec_id = db_resp.inserted_id
+    def insert_data(self, data, fields=None):
+        """
+        :param data: jenkins data
+        :param fields: additional fields of the data record, e.g. content hash
+        """
+        rec_id = None
+        fields = fields or dict()
+        if settings.JENKINS_DATA_NATIVE:
+            try:
+                record = dict(fields, payload=data)
+                rec_id = self.data_collection.insert_one(record).inserted_id
+            except InvalidDocument as e:
+                # keys with '.' or '$' can't be stored natively
+                log.warning("storing data as json string: {}".format(e))
+        if not rec_id:
+            db_resp = self.data_collection.insert_one(dict(fields, data=json.dumps(data)))
+            rec_id = db_resp.inserted_id
+        bump_version(self.data_collection.name)
         return rec_id
 
     def add_data_to_doc(self, document, data):
@@ -169,11 +485,22 @@ class JenkinsBase(DbDocument):
     def get_data_record(self, data_id):
         return self.data_collection.find_one({"_id": ObjectId(data_id)})
 
+    def get_data_records_by_ids(self, data_ids, query=None, projection=None):
+        """
+        Load data records with chunked $in queries instead of one find_one per record
+        :param data_ids: list of data record ids
+        :param query: additional query predicate
+        :param projection: mongo projection
+        :return: dict of data record id (as string) to data record
+        """
+        return find_by_ids(self.data_collection, data_ids, query=query, projection=projection)
+
     def get_data_records(self, data_ids):
+        records = self.get_data_records_by_ids(data_ids)
         res = list()
         for data_id in data_ids:
-            r = self.get_data_record(data_id)
-            res.append(json.loads(r['data']))
+            r = records[str(data_id)]
+            res.append(decode_data_record(r))
         return res
 
     def _get_data(self, doc):
@@ -184,18 +511,36 @@ class JenkinsBase(DbDocument):
             # fetch data locally
             data_id = x['data']
             data = self.get_data_record(data_id)
-            return json.loads(data['data']), 200
+            if not data:
+                # record was replaced by another process
+                return None, 200
+            return decode_data_record(data), 200
         else:
             return None, 200
 
+    def get_cached_data(self, name):
+        """
+        Data of the document without fetching it from jenkins
+        :return: (data, rc), data is None if not fetched yet
+        """
+        doc = self.get(name=name)
+        return self._get_data(doc)
+
     def get_data(self, sites, name):
         doc = self.get(name=name)
         data, rc = self._get_data(doc)
         if not data and rc == 200:
-            x = doc[0]
-            data, rc = self.fetch_data(sites, x)
-            if data:
-                self.add_data_to_doc(x, data)
+            # concurrent misses of the same document wait for a single fetch
+            data, rc = single_flight("{}:{}".format(self.collection.name, name),
+                                     lambda: self.fetch_and_store_data(sites, name),
+                                     lambda: self.get_cached_data(name))
+        return data, rc
+
+    def fetch_and_store_data(self, sites, name):
+        x = self.get(name=name)[0]
+        data, rc = self.fetch_data(sites, x)
+        if data:
+            self.add_data_to_doc(x, data)
         return data, rc
 
     def fetch_data(self, sites, doc):
@@ -204,7 +549,7 @@ class JenkinsBase(DbDocument):
         site = sites.get(name=site_name)
         site = site[0]
         data, rc = self._get_jenkins_url(site, doc['url'])
-        return data, 200
+        return data, rc
 
     def fetch_data_all(self, sites):
         docs = self.get()
@@ -215,15 +560,35 @@ class JenkinsBase(DbDocument):
         return None, 200
 
     def _get_jenkins_url(self, site, uri):
-        uri = create_jenkins_uri(site['username'], site['api_key'], uri)
+        tree = settings.JENKINS_TREE.get(self.resource_type)
+        paged_key = settings.JENKINS_TREE_PAGED.get(self.resource_type)
+        page_size = settings.JENKINS_TREE_PAGE_SIZE
+        if not tree or not paged_key or not page_size:
+            data, rc = self._get_jenkins_json(site, uri, tree)
+        else:
+            data, rc = self._get_jenkins_json(site, uri, jenkins_tree_range(tree, paged_key, 0, page_size))
+            size = jenkins_array_size(data, paged_key)
+            start = page_size
+            while data and size >= page_size:
+                page_tree = jenkins_tree_range(tree, paged_key, start, start + page_size)
+                page, rc = self._get_jenkins_json(site, uri, page_tree)
+                if not page:
+                    data = None
+                    break
+                size = merge_jenkins_page(data, page, paged_key)
+                start += page_size
+        if data and data.get('building'):
+            log.info("SKIP builds that are not complete")
+            data = None
+        return data, rc
+
+    def _get_jenkins_json(self, site, uri, tree=None):
+        uri = create_jenkins_uri(site['username'], site['api_key'], uri, tree=tree)
         log.info("GET: {}".format(uri))
-        resp = requests.get(uri, verify=False)
+        resp = jenkins_http.get(site, uri)
         data = None
         if resp.ok:
             data = jenkins_response_to_json(resp.text)
-            if data.get('building'):
-                log.info("SKIP builds that are not complete")
-                data = None
         else:
             log.error(resp.text)
         return data, resp.status_code
@@ -242,50 +607,50 @@ class JenkinsCases(JenkinsBase):
 
 
 class JenkinsSites(JenkinsBase):
+    resource_type = 'site'
+
     def __init__(self):
         self.collection = db.db.jenkins_sites
         super(JenkinsSites, self).__init__()
 
+    def url_to_name(self, uri, split_last=False):
+        """
+        Convert jenkins url to the name used on report server
+        :param uri: jenkins url of job, build or test report
+        :param split_last: split last job path part, e.g. for builds <job>/<number>
+        :return: name, e.g. site:folder:job:number
+        """
+        uri = uri.rstrip('/')
+        parts = uri.split('/job/')
+        site = self.get(url=parts[0])
+        assert site, 'site was not found'
+        site = site[0]
+        site_name = site['name']
+        if split_last:
+            parts = [site_name] + parts[1:-1] + parts[-1].split('/')
+        else:
+            parts = [site_name] + parts[1:]
+        return ":".join(parts)
+
     def get_site_data(self, name):
-        doc = self.get(name=name)
-        data, rc = self._get_data(doc)
-        if not data and rc == 200:
-            # fetch data from jenkins
-            x = doc[0]
-            site = self.get(name=name)
-            site = site[0]
-            data, rc = self._get_jenkins_url(site, x['url'])
-            if data:
-                self.add_data_to_doc(x, data)
-        return data, rc
+        # site record is the site itself
+        return self.get_data(self, name)
 
 
 class JenkinsJobs(JenkinsBase):
+    resource_type = 'job'
+
     def __init__(self):
         self.collection = db.db.jenkins_jobs
         super(JenkinsJobs, self).__init__()
 
     def get_builds(self, sites, name):
-        doc = self.get(name=name)
-        data, rc = self._get_data(doc)
-        if not data and rc == 200:
-            x = doc[0]
-            site_name = x['name'].split(':')[0]
-            site = sites.get(name=site_name)
-            site = site[0]
-            data, rc = self._get_jenkins_url(site, x['url'])
-            if data:
-                self.add_data_to_doc(x, data)
-
+        data, rc = self.get_data(sites, name)
         if not data:
             builds = []
         else:
-            data_builds = data.get('builds')
-            if data_builds:
-                builds = [x['number'] for x in data_builds if x.get('number')]
-            else:
-                builds = []
-        return builds, 200
+            builds = job_build_numbers(data)
+        return builds, rc
 
     def get_jobs_by_label(self, label=None):
         res = self.get_by_fields(label=label)
@@ -293,12 +658,14 @@ class JenkinsJobs(JenkinsBase):
 
     def get_jobs_labels(self):
         res = set()
-        for x in self.collection.find():
+        for x in self.get_by_fields():
             res.add(x['label'])
         return {"unique_labels": list(res)}
 
 
 class JenkinsBuilds(JenkinsBase):
+    resource_type = 'build'
+
     def __init__(self):
         self.collection = db.db.jenkins_builds
         super(JenkinsBuilds, self).__init__()
@@ -306,7 +673,8 @@ class JenkinsBuilds(JenkinsBase):
     def build_name_to_job_name(self, build_name):
         return ":".join(build_name.split(":")[:-1])
 
-    def filter_artifacts(self, artifacts, search):
+    @staticmethod
+    def filter_artifacts(artifacts, search):
         """
         
         :param search: list of file search patterns 
@@ -325,6 +693,62 @@ class JenkinsBuilds(JenkinsBase):
             arts = artifacts
         return arts
 
+    def download_artifact(self, site, uri):
+        """
+        Stream artifact content, runs in artifact download workers
+        :return: (content bytes, sha256 hex digest) or (None, None) if failed or too large
+        """
+        resp = jenkins_http.get(site, uri, stream=True)
+        try:
+            if not resp.ok:
+                log.error("can't download artifact {}: {}".format(uri, resp.status_code))
+                return None, None
+            length = resp.headers.get('Content-Length')
+            if length and int(length) > settings.ARTIFACT_MAX_BYTES:
+                log.warning("SKIP artifact {}, {} bytes".format(uri, length))
+                return None, None
+            sha = hashlib.sha256()
+            parts = list()
+            size = 0
+            for chunk in resp.iter_content(chunk_size=64 * 1024):
+                size += len(chunk)
+                if size > settings.ARTIFACT_MAX_BYTES:
+                    log.warning("SKIP artifact {}, more than {} bytes".format(uri, settings.ARTIFACT_MAX_BYTES))
+                    return None, None
+                sha.update(chunk)
+                parts.append(chunk)
+        finally:
+            resp.close()
+        return b"".join(parts), sha.hexdigest()
+
+    def store_artifact(self, path, content, digest):
+        """
+        Store artifact as data record, large artifacts go to GridFS,
+        artifact with the same path and content is stored once
+        :return: data record id or None if content is not json
+        """
+        existing = self.data_collection.find_one({"sha256": digest, "artifact": path}, {"_id": 1})
+        if existing:
+            return existing['_id']
+        try:
+            d = json.loads(content.decode('utf-8'))
+        except ValueError as e:
+            log.error("artifact {} is not json: {}".format(path, e))
+            return None
+        if len(content) > settings.ARTIFACT_INLINE_MAX_BYTES:
+            file_id = artifacts_fs().put(content, filename=path, sha256=digest)
+            data = {
+                "name": path,
+                "gridfs_id": str(file_id),
+                "size": len(content)
+            }
+        else:
+            data = {
+                "name": path,
+                "content": d
+            }
+        return self.insert_data(data, fields={"sha256": digest, "artifact": path})
+
     def get_artifacts(self, sites, name, artifacts):
         if not artifacts:
             return []
@@ -342,18 +766,19 @@ class JenkinsBuilds(JenkinsBase):
             site_name = build['name'].split(':')[0]
             site = sites.get(name=site_name)
             site = site[0]
-            rec_ids = list()
+            uris = list()
             for art in artifacts:
                 art_uri = "{}/artifact/{}".format(build['url'], art['relativePath'])
-                uri = insert_creds_to_jenkins_url(site['username'], site['api_key'], art_uri)
-                resp = requests.get(uri, verify=False)
-                if resp.ok:
-                    d = json.loads(resp.text)
-                    data = {
-                        "name": art['relativePath'],
-                        "content": d
-                    }
-                    rec_id = self.insert_data(data)
+                uris.append(insert_creds_to_jenkins_url(site['username'], site['api_key'], art_uri))
+            # downloads run in parallel, records are stored here in artifacts order
+            with ThreadPoolExecutor(max_workers=settings.ARTIFACT_DOWNLOAD_WORKERS) as pool:
+                downloads = list(pool.map(lambda uri: self.download_artifact(site, uri), uris))
+            rec_ids = list()
+            for art, (content, digest) in zip(artifacts, downloads):
+                if content is None:
+                    continue
+                rec_id = self.store_artifact(art['relativePath'], content, digest)
+                if rec_id:
                     rec_ids.append(str(rec_id))
             build['artifacts'] = artifact_ids + rec_ids
             self.update(build['name'], build)
@@ -375,24 +800,128 @@ class JenkinsBuilds(JenkinsBase):
             builds = [b for b in builds if self.build_name_to_job_name(b['name']) in job_names]
         return builds
 
+    def get_latest_by_branch(self, job_names, data_fields=None):
+        """
+        Latest completed build of every (branch, job), branch is the first 3 parts of the build label,
+        build numbers are compared numerically
+        :param job_names: names of the jobs
+        :param data_fields: populate builds with these data fields
+        :return: list of builds with job, branch and number fields
+        """
+        if not job_names:
+            return []
+        build_regexes = [{"name": {"$regex": "^{}:[0-9]+$".format(re.escape(x))}} for x in job_names]
+        pipeline = [
+            # builds get data once completed
+            {"$match": {"$or": build_regexes,
+                        "label": {"$nin": [None, "", "null"]},
+                        "data": {"$nin": [None, ""]}}},
+            {"$addFields": {"name_parts": {"$split": ["$name", ":"]},
+                            "label_parts": {"$split": [{"$toString": "$label"}, "."]}}},
+            {"$addFields": {
+                "number": {"$toLong": {"$arrayElemAt": ["$name_parts", -1]}},
+                "job": agg_join({"$slice": ["$name_parts", {"$subtract": [{"$size": "$name_parts"}, 1]}]}, ":"),
+                "branch": agg_join({"$slice": ["$label_parts", 3]}, ".")
+            }},
+            {"$sort": {"job": 1, "branch": 1, "number": -1}},
+            {"$group": {"_id": {"job": "$job", "branch": "$branch"}, "build": {"$first": "$$ROOT"}}},
+            {"$replaceRoot": {"newRoot": "$build"}},
+            {"$project": {"name_parts": 0, "label_parts": 0}},
+            {"$sort": {"branch": 1, "job": 1}},
+        ]
+        builds = list(self.collection.aggregate(pipeline, allowDiskUse=True))
+        if data_fields:
+            builds = self.populate_data(builds, data_fields)
+        return builds
+
+
+class JenkinsSummaries(DbDocument):
+    """
+    Test results of the latest test report of every job, updated when test reports are stored
+    """
+    fields = ["failCount", "passCount", "skipCount", "duration"]
+
+    def __init__(self):
+        self.collection = db.db.jenkins_summaries
+        self.jobs_collection = db.db.jenkins_jobs
+
+    @classmethod
+    def summary_document(cls, report, label, data):
+        summary = {
+            "job": report['job'],
+            "label": label,
+            "build": report['build'],
+            "build_number": int(report['build']),
+            "name": report['name'],
+            "url": report['url'],
+            "updated": time.time()
+        }
+        for f in cls.fields:
+            summary[f] = data.get(f)
+        return summary
+
+    def update_summary(self, report, data):
+        """
+        Replace job summary if the report is newer than the summarized one
+        :param report: test report record
+        :param data: test report jenkins data
+        :return: True if summary was updated
+        """
+        job = self.jobs_collection.find_one({"name": report['job']}, {"label": 1})
+        summary = self.summary_document(report, job and job.get('label'), data)
+        try:
+            self.collection.update_one({"job": report['job'], "build_number": {"$lt": summary['build_number']}},
+                                       {"$set": summary},
+                                       upsert=True)
+        except DuplicateKeyError:
+            # summary of a newer build exists
+            return False
+        self.changed()
+        return True
+
+    def get_summaries(self, label=None):
+        query = dict()
+        if label:
+            query["label"] = label
+        return list(self.collection.find(query, {"_id": 0}))
+
+    def rebuild(self, test_reports):
+        """
+        Rebuild summaries from stored test reports
+        :param test_reports: JenkinsTestReports model
+        :return: number of summaries
+        """
+        self.collection.delete_many({})
+        self.changed()
+        reports = test_reports.get_reports(data=True, last=1, data_fields=",".join(self.fields))
+        for report in reports:
+            self.update_summary(report, report['data'])
+        return len(reports)
+
 
 class JenkinsTestReports(JenkinsBase):
+    resource_type = 'testReport'
+
     def __init__(self):
         self.collection = db.db.jenkins_test_reports
         self.suites = JenkinsSuites()
         self.cases = JenkinsCases()
+        self.summaries = JenkinsSummaries()
         super(JenkinsTestReports, self).__init__()
 
     def get_tests_from_builds(self, builds_response, test_data_fields=None):
+        if not test_data_fields:
+            test_data_fields = "*"
+        names = ["{}:testReport".format(build['name']) for build in builds_response]
+        reports = self.get_by_names(names)
+        reports = self.populate_data(reports, test_data_fields)
+        reports = dict((r['name'], r) for r in reports)
         res = list()
         for build in builds_response:
             build_name = build['name']
             test_report_name = "{}:testReport".format(build_name)
-            if not test_data_fields:
-                test_data_fields = "*"
-            resp = self.get(name=test_report_name, data_fields=test_data_fields)
+            resp = reports.get(test_report_name)
             if resp:
-                resp = resp[0]
                 d = {
                     "name": resp["name"],
                     "url": resp["url"],
@@ -403,126 +932,196 @@ class JenkinsTestReports(JenkinsBase):
                 res.append(d)
         return res
 
+    def iter_tests_from_builds(self, builds, test_data_fields=None):
+        """
+        Streaming version of get_tests_from_builds
+        :param builds: iterable of builds populated with data
+        """
+        for builds_chunk in iter_chunks(builds, settings.DATA_RECORDS_CHUNK_SIZE):
+            for x in self.get_tests_from_builds(builds_chunk, test_data_fields=test_data_fields):
+                yield x
+
+    def insert_report(self, data):
+        """
+        Create test report record, test results are populated by get_data
+        :param data: {url: <build_url>/testReport, name: site:job_path:build_number:testReport}
+        :return: record id or False if the report exists
+        """
+        names = data['name'].split(':')
+        data['job'] = ":".join(names[:-2])
+        data['build'] = names[-2]
+        return self.insert(data)
+
     def insert_cases(self, cases):
-        case_ids = list()
-        for case in cases:
-            # import bson
-            # print(len(bson.BSON.encode(suite)))
-            case_id = self.cases.insert(case, allow_duplicates=True)
-            if case_id:
-                case_ids.append(case_id)
-        return case_ids
+        return self.cases.insert_many(cases, allow_duplicates=True)
 
     def insert_suites(self, suites):
-        suite_ids = list()
+        """
+        Insert suites and their cases in two bulk writes, cases in suites are replaced by case ids
+        :param suites: suites of jenkins test report
+        :return: list of suite ids
+        """
+        start = time.time()
+        cases = list()
+        case_slices = list()
         for suite in suites:
+            suite_cases = suite.get('cases') or list()
+            case_slices.append((len(cases), len(suite_cases)))
+            cases.extend(suite_cases)
+        case_ids = self.insert_cases(cases)
+        for suite, (offset, num_cases) in zip(suites, case_slices):
             if suite.get('cases'):
-                case_ids = self.insert_cases(suite['cases'])
-                suite['cases'] = case_ids
-            suite_id = self.suites.insert(suite, allow_duplicates=True)
-            if suite_id:
-                suite_ids.append(str(suite_id))
-        return suite_ids
+                suite['cases'] = case_ids[offset:offset + num_cases]
+        suite_ids = self.suites.insert_many(suites, allow_duplicates=True)
+        elapsed = time.time() - start
+        log.info("Inserted {} suites and {} cases in {:.2f}s ({:.0f} docs/s)".format(
+            len(suite_ids), len(case_ids), elapsed, (len(suite_ids) + len(case_ids)) / max(elapsed, 1e-6)))
+        return [str(suite_id) for suite_id in suite_ids]
 
     def get_suites(self, name):
         doc = self.get(name=name, data_fields="suites")
         x = doc[0]
         suite_ids = x['data'].get('suites', list())
+        suites = self.suites.get_docs_by_ids(suite_ids)
         res = list()
         for suite_id in suite_ids:
-            s, _ = self.get_suites_by_id(suite_id)
-            res.append(s)
+            s = suites.get(str(suite_id))
+            if s:
+                res.append(self._suite_to_json(s))
         return res, 200
 
-    def get_suites_by_id(self, suite_id):
-        s = self.suites.get_doc(doc_id=suite_id)
+    def _suite_to_json(self, s):
         s['_id'] = str(s['_id'])
         if s.get('cases'):
             s['cases'] = [str(case_id) for case_id in s['cases']]
-        return s, 200
+        return s
+
+    def get_suites_by_id(self, suite_id):
+        s = self.suites.get_doc(doc_id=suite_id)
+        return self._suite_to_json(s), 200
 
     def get_cases(self, name, cases_fields=None):
+        """
+        Suites of the test report with cases, cases are loaded with $in queries
+        :param name: test report name
+        :param cases_fields: comma separated list of case fields to return, all fields if not set
+        :return: 
+        """
         if cases_fields is not None and cases_fields != "*":
-            cases_fields_list = cases_fields.split(',')
+            projection = dict((f, 1) for f in cases_fields.split(','))
         else:
-            cases_fields_list = None
+            projection = None
         res, _ = self.get_suites(name)
-        for i, r in enumerate(res):
-            case_ids = r.get('cases', None)
-            if case_ids:
-                cases = list()
-                for case_id in case_ids:
-                    case, _ = self.get_cases_by_id(case_id)
-                    # filter out fields
-                    if cases_fields_list:
-                        for k in case.keys():
-                            if k not in cases_fields:
-                                del case[k]
-                    cases.append(case)
-                res[i]['cases'] = cases
+        case_ids = [case_id for r in res for case_id in r.get('cases') or list()]
+        cases = self.cases.get_docs_by_ids(case_ids, projection=projection)
+        for r in res:
+            if r.get('cases'):
+                r['cases'] = [self._case_to_json(cases[case_id]) for case_id in r['cases'] if case_id in cases]
         return res, 200
 
+    def _case_to_json(self, s):
+        s['_id'] = str(s['_id'])
+        return s
+
     def get_cases_by_id(self, case_id):
         s = self.cases.get_doc(doc_id=case_id)
-        s['_id'] = str(s['_id'])
-        return s, 200
+        return self._case_to_json(s), 200
 
-    def get_data(self, sites, name):
+    def fetch_and_store_data(self, sites, name):
         """
         Overrides base class method since we want to store suites data separately
         :param sites: 
         :param name: 
         :return: 
         """
-        doc = self.get(name=name)
-        data, rc = self._get_data(doc)
-        if not data and rc == 200:
-            # fetch data from jenkins
-            x = doc[0]
-            site_name = x['name'].split(':')[0]
-            site = sites.get(name=site_name)
-            site = site[0]
-            data, rc = self._get_jenkins_url(site, x['url'])
-            if data and data.get('suites'):
-                # store suites in separate collection
-                suites = data['suites']
-                suite_ids = self.insert_suites(suites)
-                data['suites'] = suite_ids
-                self.add_data_to_doc(x, data)
+        x = self.get(name=name)[0]
+        data, rc = self.fetch_data(sites, x)
+        if data and data.get('suites'):
+            # store suites in separate collection
+            suites = data['suites']
+            suite_ids = self.insert_suites(suites)
+            data['suites'] = suite_ids
+            self.add_data_to_doc(x, data)
+            self.summaries.update_summary(x, data)
         return data, rc
 
+    def get_last_reports(self, last, query=None):
+        """
+        Last N reports of every job, build numbers are compared numerically
+        :param last: number of reports per job
+        :param query: filter applied before selecting last reports
+        :return: list of test reports
+        """
+        pipeline = [
+            {"$match": query or {}},
+            {"$sort": {"job": 1, "build": -1}},
+        ]
+        if last == 1:
+            pipeline = pipeline + [
+                {"$group": {"_id": "$job", "report": {"$first": "$$ROOT"}}},
+                {"$replaceRoot": {"newRoot": "$report"}},
+            ]
+            cursor = self.collection.aggregate(pipeline,
+                                               collation=BUILD_NUMBER_COLLATION,
+                                               allowDiskUse=True)
+            return list(cursor)
+        # only ids are grouped, whole report histories of large jobs
+        # would exceed the $group memory and document size limits
+        pipeline = pipeline + [
+            {"$group": {"_id": "$job", "ids": {"$push": "$_id"}}},
+            {"$project": {"ids": {"$slice": ["$ids", last]}}},
+            {"$unwind": "$ids"},
+        ]
+        cursor = self.collection.aggregate(pipeline,
+                                           collation=BUILD_NUMBER_COLLATION,
+                                           allowDiskUse=True)
+        ids = [x['ids'] for x in cursor]
+        order = dict((x, i) for i, x in enumerate(ids))
+        reports = list()
+        for ids_chunk in chunks(ids, settings.DATA_RECORDS_CHUNK_SIZE):
+            reports.extend(self.collection.find({"_id": {"$in": ids_chunk}}))
+        return sorted(reports, key=lambda r: order[r['_id']])
+
+    def get_build_results(self, builds, data_fields):
+        """
+        Test report data of builds, fetched in batches
+        :param builds: list of builds
+        :param data_fields: test report data fields
+        :return: dict of build name to test report with populated data
+        """
+        names = ["{}:testReport".format(b['name']) for b in builds]
+        reports = self.populate_data(self.get_by_names(names), data_fields)
+        return dict((r['name'][:-len(":testReport")], r) for r in reports)
+
     def get_reports(self,
                     data=None,
                     last=None,
                     data_fields=None,
                     names=None):
         if names:
-            names = names.split(',')
-            res = list()
-            for name in names:
-                # convert build name to testresport name
-                name = "{}:testReport".format(name)
-                res = res + self.get_by_fields(name=name)
+            # convert build names to testreport names
+            names = ["{}:testReport".format(name) for name in names.split(',')]
+            order = dict((name, i) for i, name in enumerate(names))
+            res = self.get_by_names(names)
+            res = sorted(res, key=lambda r: order[r['name']])
             # invalidate "last" key, since we supplied explicitly the names
             last = None
+        elif last:
+            if data:
+                query = {"data": {"$exists": True, "$nin": [None, ""]}}
+            elif data is None:
+                query = None
+            else:
+                query = {"data": {"$in": [None, ""]}}
+            res = self.get_last_reports(last, query=query)
         else:
             res = self.get_by_fields()
         if data:
-            res = [r for r in res if self.has_data(r)]
+            res = self.filter_by_data(res)
         elif data is None:
             pass
         else:
-            res = [r for r in res if not self.has_data(r)]
-        if last:
-            jobs = set([r['job'] for r in res])
-            x = list()
-            for job in jobs:
-                r_job = [r for r in res if r['job'] == job]
-                builds = [r['build'] for r in r_job]
-                builds = sorted(builds, reverse=True)
-                builds = builds if len(builds) <= last else builds[:last]
-                x = x + [r for r in r_job if r['job'] == job and r['build'] in builds]
-            res = x
+            res = self.filter_by_data(res, with_data=False)
         if data and data_fields:
             # populate and filter data
             res = self.populate_data(res, data_fields)
@@ -0,0 +1,111 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+Single-flight jenkins fetches: concurrent misses of the same document wait for one fetch.
+Threads of a process share the result of the leader thread, processes coordinate with
+an atomic claim document in jenkins_fetch_claims.
+"""
+import datetime
+import logging
+import os
+import socket
+import threading
+import time
+
+from pymongo.errors import DuplicateKeyError
+
+from server import settings
+from server.db import db
+
+log = logging.getLogger(__name__)
+
+
+class Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+flights = dict()
+flights_lock = threading.Lock()
+
+
+def single_flight(key, fetch, cached):
+    """
+    :param key: document key, e.g. <collection>:<name>
+    :param fetch: fetches and stores document data, returns (data, rc)
+    :param cached: reads stored document data, returns (data, rc)
+    :return: (data, rc)
+    """
+    with flights_lock:
+        flight = flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = Flight()
+            flights[key] = flight
+    if not leader:
+        flight.done.wait(settings.SINGLE_FLIGHT_TIMEOUT)
+        if flight.result is not None:
+            return flight.result
+        return cached()
+    try:
+        flight.result = claimed_fetch(key, fetch, cached)
+        return flight.result
+    finally:
+        with flights_lock:
+            del flights[key]
+        flight.done.set()
+
+
+def claim_fields(owner):
+    now = time.time()
+    return {
+        "owner": owner,
+        "expires": now + settings.SINGLE_FLIGHT_CLAIM_TTL,
+        # removed by TTL index if never released
+        "expires_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=2 * settings.SINGLE_FLIGHT_CLAIM_TTL)
+    }
+
+
+def expired_claim(key):
+    """
+    :return: query of the claim of key if its owner died while fetching
+    """
+    return {"_id": key, "expires": {"$lt": time.time()}}
+
+
+def claim(claims, key, owner):
+    fields = claim_fields(owner)
+    try:
+        claims.insert_one(dict(fields, _id=key))
+        return True
+    except DuplicateKeyError:
+        # take over claim of a process that died while fetching
+        x = claims.find_one_and_update(expired_claim(key), {"$set": fields})
+        return x is not None
+
+
+def claimed_fetch(key, fetch, cached):
+    """
+    Fetch if this process owns the claim of the key,
+    otherwise wait until the owner stored the data or released the claim
+    """
+    claims = db.db.jenkins_fetch_claims
+    owner = "{}:{}:{}".format(socket.gethostname(), os.getpid(), threading.current_thread().ident)
+    deadline = time.time() + settings.SINGLE_FLIGHT_TIMEOUT
+    while True:
+        if claim(claims, key, owner):
+            try:
+                # the previous owner might have stored the data already
+                data, rc = cached()
+                if data or rc != 200:
+                    return data, rc
+                return fetch()
+            finally:
+                claims.delete_one({"_id": key, "owner": owner})
+        log.info("waiting for {} fetched by another process".format(key))
+        time.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+        data, rc = cached()
+        if data or rc != 200 or time.time() > deadline:
+            return data, rc
@@ -0,0 +1,40 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+Change counters of collections, bumped on every write through the model classes.
+Used to build ETags without reading the collections themselves.
+"""
+import hashlib
+
+from server.db import db
+
+# collections jenkins data is stored in
+DATA_COLLECTIONS = ['jenkins_sites', 'jenkins_jobs', 'jenkins_builds', 'jenkins_test_reports',
+                    'jenkins_suites', 'jenkins_cases', 'jenkins_data', 'jenkins_summaries', 'jenkins_labels']
+
+
+def bump_version(collection_name):
+    db.db.jenkins_versions.update_one({"_id": collection_name},
+                                      {"$inc": {"version": 1}},
+                                      upsert=True)
+
+
+def get_versions(collection_names):
+    """
+    :return: dict of collection name to version, 0 for collections never written
+    """
+    versions = dict((name, 0) for name in collection_names)
+    for x in db.db.jenkins_versions.find({"_id": {"$in": list(collection_names)}}):
+        versions[x['_id']] = x['version']
+    return versions
+
+
+def data_version(collection_names=None):
+    """
+    :param collection_names: collections of DATA_COLLECTIONS, all of them if not set
+    :return: (version string changing on every write to the collections, dict of collection versions)
+    """
+    versions = get_versions(collection_names or DATA_COLLECTIONS)
+    key = repr(sorted(versions.items()))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16], versions
@@ -0,0 +1,229 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+Per-endpoint request metrics: wall time, mongo commands, jenkins requests and json serialization.
+Mongo commands are counted by a pymongo command listener, jenkins requests by jenkins_http,
+both are attributed to the request running in the same thread. Work done in other threads
+or while a streamed response is sent is counted under the "background" endpoint.
+Exposed in prometheus text format on /metrics and optionally as Server-Timing header.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, request
+from pymongo import monitoring
+
+from server import settings
+
+# no request in this thread, e.g. fetch queue workers
+BACKGROUND = "background"
+
+_local = threading.local()
+
+
+class RequestMetrics(object):
+    """
+    Counters of the request running in the current thread
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.mongo_commands = 0
+        self.mongo_seconds = 0.0
+        self.jenkins_requests = 0
+        self.jenkins_bytes = 0
+        self.jenkins_seconds = 0.0
+        self.serialize_seconds = 0.0
+
+
+class EndpointMetrics(object):
+    """
+    Totals of one endpoint
+    """
+    def __init__(self):
+        self.requests = dict()
+        self.buckets = [0] * len(settings.METRICS_BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.mongo_commands = 0
+        self.mongo_seconds = 0.0
+        self.jenkins_requests = 0
+        self.jenkins_bytes = 0
+        self.jenkins_seconds = 0.0
+        self.serialize_seconds = 0.0
+
+    def add(self, x, elapsed, status):
+        self.requests[status] = self.requests.get(status, 0) + 1
+        for i, bound in enumerate(settings.METRICS_BUCKETS):
+            if elapsed <= bound:
+                self.buckets[i] += 1
+        self.count += 1
+        self.seconds += elapsed
+        self.add_calls(x)
+
+    def add_calls(self, x):
+        self.mongo_commands += x.mongo_commands
+        self.mongo_seconds += x.mongo_seconds
+        self.jenkins_requests += x.jenkins_requests
+        self.jenkins_bytes += x.jenkins_bytes
+        self.jenkins_seconds += x.jenkins_seconds
+        self.serialize_seconds += x.serialize_seconds
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = dict()
+
+    def current(self):
+        return getattr(_local, 'metrics', None)
+
+    def begin(self):
+        _local.metrics = RequestMetrics()
+
+    def end(self, endpoint, status):
+        """
+        :return: metrics of the finished request
+        """
+        x = self.current()
+        _local.metrics = None
+        if x is None:
+            return None
+        elapsed = time.time() - x.start
+        with self.lock:
+            self.endpoints.setdefault(endpoint, EndpointMetrics()).add(x, elapsed, status)
+        x.elapsed = elapsed
+        return x
+
+    def add_background(self, x):
+        with self.lock:
+            self.endpoints.setdefault(BACKGROUND, EndpointMetrics()).add_calls(x)
+
+    def observe_mongo(self, seconds):
+        x = self.current()
+        if x is None:
+            x = RequestMetrics()
+            x.mongo_commands, x.mongo_seconds = 1, seconds
+            self.add_background(x)
+            return
+        x.mongo_commands += 1
+        x.mongo_seconds += seconds
+
+    def observe_jenkins(self, seconds, num_bytes):
+        x = self.current()
+        if x is None:
+            x = RequestMetrics()
+            x.jenkins_requests, x.jenkins_bytes, x.jenkins_seconds = 1, num_bytes, seconds
+            self.add_background(x)
+            return
+        x.jenkins_requests += 1
+        x.jenkins_bytes += num_bytes
+        x.jenkins_seconds += seconds
+
+    @contextmanager
+    def serializing(self):
+        start = time.time()
+        try:
+            yield
+        finally:
+            x = self.current()
+            if x is not None:
+                x.serialize_seconds += time.time() - start
+
+    def render(self):
+        """
+        :return: metrics in prometheus text format
+        """
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            lines = list()
+
+            def sample(name, labels, value):
+                labels = ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels)
+                lines.append("{}{{{}}} {}".format(name, labels, value))
+
+            def header(name, kind, help_text):
+                lines.append("# HELP {} {}".format(name, help_text))
+                lines.append("# TYPE {} {}".format(name, kind))
+
+            header("reporter_requests_total", "counter", "Requests by endpoint and status code")
+            for endpoint, x in endpoints:
+                for status, count in sorted(x.requests.items()):
+                    sample("reporter_requests_total", (("endpoint", endpoint), ("code", status)), count)
+
+            header("reporter_request_duration_seconds", "histogram", "Request wall time")
+            for endpoint, x in endpoints:
+                if not x.count:
+                    continue
+                for bound, count in zip(settings.METRICS_BUCKETS, x.buckets):
+                    sample("reporter_request_duration_seconds_bucket", (("endpoint", endpoint), ("le", bound)), count)
+                sample("reporter_request_duration_seconds_bucket", (("endpoint", endpoint), ("le", "+Inf")), x.count)
+                sample("reporter_request_duration_seconds_sum", (("endpoint", endpoint),), x.seconds)
+                sample("reporter_request_duration_seconds_count", (("endpoint", endpoint),), x.count)
+
+            for name, attr, help_text in (
+                    ("reporter_mongo_commands_total", "mongo_commands", "Mongo commands"),
+                    ("reporter_mongo_seconds_total", "mongo_seconds", "Time in mongo commands"),
+                    ("reporter_jenkins_requests_total", "jenkins_requests", "Jenkins HTTP requests"),
+                    ("reporter_jenkins_bytes_total", "jenkins_bytes", "Bytes read from jenkins"),
+                    ("reporter_jenkins_seconds_total", "jenkins_seconds", "Time in jenkins requests"),
+                    ("reporter_serialize_seconds_total", "serialize_seconds", "Time in json serialization")):
+                header(name, "counter", help_text)
+                for endpoint, x in endpoints:
+                    sample(name, (("endpoint", endpoint),), getattr(x, attr))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.observe_mongo(event.duration_micros / 1e6)
+
+    def failed(self, event):
+        metrics.observe_mongo(event.duration_micros / 1e6)
+
+
+_listener = None
+
+
+def server_timing(x):
+    return ", ".join([
+        "app;dur={:.1f}".format(1000 * x.elapsed),
+        'mongo;dur={:.1f};desc="{} commands"'.format(1000 * x.mongo_seconds, x.mongo_commands),
+        'jenkins;dur={:.1f};desc="{} requests"'.format(1000 * x.jenkins_seconds, x.jenkins_requests),
+        "serialize;dur={:.1f}".format(1000 * x.serialize_seconds)
+    ])
+
+
+def init_metrics(flask_app):
+    """
+    Has to be called before db.init_app, command listeners are only added to new mongo clients
+    """
+    global _listener
+    if not settings.METRICS_ENABLED:
+        return
+    if _listener is None:
+        _listener = MongoCommandListener()
+        monitoring.register(_listener)
+
+    @flask_app.before_request
+    def begin_request():
+        metrics.begin()
+
+    @flask_app.after_request
+    def end_request(resp):
+        endpoint = request.url_rule and request.url_rule.rule or "unmatched"
+        x = metrics.end("{} {}".format(request.method, endpoint), resp.status_code)
+        if x is not None and settings.METRICS_SERVER_TIMING:
+            resp.headers['Server-Timing'] = server_timing(x)
+        return resp
+
+    @flask_app.route(settings.METRICS_PATH)
+    def prometheus_metrics():
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
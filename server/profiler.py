@@ -0,0 +1,252 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+Opt-in profiling of slow or sampled requests, used by the report server and the flask front-end.
+Only depends on flask, configured through the app config:
+
+    PROFILER_ENABLED       profile requests at all
+    PROFILER_MODE          "cprofile" or "sample" (stack sampling, low overhead)
+    PROFILER_THRESHOLD     keep profiles of requests slower than this many seconds, 0 disables
+    PROFILER_SAMPLE_RATE   fraction of requests profiled regardless of their time
+    PROFILER_SAMPLE_INTERVAL  seconds between stack samples in "sample" mode
+    PROFILER_DIR           directory of profile dumps, only the newest PROFILER_MAX_FILES are kept
+    PROFILER_PATH          admin endpoint listing the dumps, <PROFILER_PATH>/<name> shows top-N hotspots
+    PROFILER_TOP_N         number of hotspots shown
+    PROFILER_TOKEN         if set, required as X-Profiler-Token header or token query arg of admin endpoint
+"""
+import cProfile
+import io
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import Response, abort, g, jsonify, request, send_file
+
+DEFAULTS = {
+    "PROFILER_ENABLED": False,
+    "PROFILER_MODE": "cprofile",
+    "PROFILER_THRESHOLD": 1.0,
+    "PROFILER_SAMPLE_RATE": 0.0,
+    "PROFILER_SAMPLE_INTERVAL": 0.005,
+    "PROFILER_DIR": "profiles",
+    "PROFILER_MAX_FILES": 100,
+    "PROFILER_PATH": "/admin/profiles",
+    "PROFILER_TOP_N": 30,
+    "PROFILER_TOKEN": None,
+}
+PROFILE_NAME = re.compile(r'^[\w.-]+\.(prof|stacks)$')
+
+
+class StackSampler(object):
+    """
+    Background thread counting the stacks of threads serving profiled requests
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.threads = dict()
+        self.thread = None
+
+    def start(self, thread_id):
+        counter = Counter()
+        with self.lock:
+            self.threads[thread_id] = counter
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="stack-sampler", daemon=True)
+                self.thread.start()
+        return counter
+
+    def stop(self, thread_id):
+        with self.lock:
+            return self.threads.pop(thread_id, None)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.threads:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, counter in self.threads.items():
+                    frame = frames.get(thread_id)
+                    stack = list()
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append("{} ({}:{})".format(code.co_name, code.co_filename, frame.f_lineno))
+                        frame = frame.f_back
+                    if stack:
+                        counter[tuple(reversed(stack))] += 1
+
+
+def stacks_summary(fname, top_n):
+    """
+    :return: hotspots of a stack samples dump, by samples on top of the stack and anywhere in the stack
+    """
+    own = Counter()
+    total = Counter()
+    samples = 0
+    with open(fname) as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if not stack:
+                continue
+            count = int(count)
+            frames = stack.split(';')
+            samples += count
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+    out = ["{} samples".format(samples), "", "own samples"]
+    for frame, count in own.most_common(top_n):
+        out.append("{:>8} {:>6.1f}%  {}".format(count, 100.0 * count / max(samples, 1), frame))
+    out += ["", "samples in stack"]
+    for frame, count in total.most_common(top_n):
+        out.append("{:>8} {:>6.1f}%  {}".format(count, 100.0 * count / max(samples, 1), frame))
+    return "\n".join(out) + "\n"
+
+
+def cprofile_summary(fname, top_n, sort):
+    out = io.StringIO()
+    stats = pstats.Stats(fname, stream=out)
+    stats.sort_stats(sort).print_stats(top_n)
+    return out.getvalue()
+
+
+class Profiler(object):
+    def __init__(self, config):
+        self.config = config
+        self.sampler = StackSampler(config['PROFILER_SAMPLE_INTERVAL'])
+        self.lock = threading.Lock()
+        os.makedirs(config['PROFILER_DIR'], exist_ok=True)
+
+    def begin(self):
+        if request.path.startswith(self.config['PROFILER_PATH']):
+            return
+        sampled = random.random() < self.config['PROFILER_SAMPLE_RATE']
+        if not sampled and not self.config['PROFILER_THRESHOLD']:
+            return
+        g.profile_start = time.time()
+        g.profile_sampled = sampled
+        if self.config['PROFILER_MODE'] == "sample":
+            g.profile_stacks = self.sampler.start(threading.get_ident())
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # only one cProfile can be active at a time on python 3.12+
+            return
+        g.profile = profile
+
+    def end(self, resp):
+        start = g.pop('profile_start', None)
+        if start is None:
+            return resp
+        profile = g.pop('profile', None)
+        stacks = None
+        if profile is not None:
+            profile.disable()
+        elif 'profile_stacks' in g:
+            g.pop('profile_stacks')
+            stacks = self.sampler.stop(threading.get_ident())
+        elapsed = time.time() - start
+        threshold = self.config['PROFILER_THRESHOLD']
+        if not g.pop('profile_sampled', False) and not (threshold and elapsed >= threshold):
+            return resp
+        if profile is None and stacks is None:
+            return resp
+        name = "{}_{:06d}ms_{}_{}".format(time.strftime("%Y%m%d-%H%M%S"),
+                                          int(1000 * elapsed),
+                                          request.method,
+                                          re.sub(r'[^\w.-]+', '_', request.path).strip('_')[:80] or "root")
+        if profile is not None:
+            profile.dump_stats(os.path.join(self.config['PROFILER_DIR'], name + ".prof"))
+        else:
+            with open(os.path.join(self.config['PROFILER_DIR'], name + ".stacks"), 'w') as f:
+                for stack, count in stacks.items():
+                    f.write("{} {}\n".format(";".join(stack), count))
+        self.rotate()
+        return resp
+
+    def teardown(self, exc):
+        # request failed before after_request
+        if g.pop('profile_start', None) is None:
+            return
+        profile = g.pop('profile', None)
+        if profile is not None:
+            profile.disable()
+        if g.pop('profile_stacks', None) is not None:
+            self.sampler.stop(threading.get_ident())
+
+    def rotate(self):
+        with self.lock:
+            profiles = self.list()
+            for x in profiles[self.config['PROFILER_MAX_FILES']:]:
+                try:
+                    os.remove(os.path.join(self.config['PROFILER_DIR'], x['name']))
+                except OSError:
+                    pass
+
+    def list(self):
+        """
+        :return: profile dumps, newest first
+        """
+        r = list()
+        for fname in os.listdir(self.config['PROFILER_DIR']):
+            if not PROFILE_NAME.match(fname):
+                continue
+            st = os.stat(os.path.join(self.config['PROFILER_DIR'], fname))
+            r.append({"name": fname, "size": st.st_size, "mtime": st.st_mtime})
+        return sorted(r, key=lambda x: x['mtime'], reverse=True)
+
+    def check_token(self):
+        token = self.config['PROFILER_TOKEN']
+        if token and token not in (request.headers.get('X-Profiler-Token'), request.args.get('token')):
+            abort(403)
+
+    def summary(self, name):
+        """
+        Top-N hotspots of a dump, ?n=<top n>, ?sort=<pstats sort key> for cProfile dumps,
+        ?raw=1 downloads the dump
+        """
+        self.check_token()
+        if not PROFILE_NAME.match(name):
+            abort(404)
+        fname = os.path.join(os.path.abspath(self.config['PROFILER_DIR']), name)
+        if not os.path.isfile(fname):
+            abort(404)
+        if request.args.get('raw'):
+            return send_file(fname, as_attachment=True)
+        top_n = int(request.args.get('n', self.config['PROFILER_TOP_N']))
+        if name.endswith(".prof"):
+            text = cprofile_summary(fname, top_n, request.args.get('sort', 'cumulative'))
+        else:
+            text = stacks_summary(fname, top_n)
+        return Response(text, mimetype="text/plain")
+
+
+def init_profiler(flask_app):
+    """
+    Add profiling hooks and admin endpoint if PROFILER_ENABLED is set in the app config
+    """
+    config = dict((k, flask_app.config.get(k, v)) for k, v in DEFAULTS.items())
+    if not config['PROFILER_ENABLED']:
+        return None
+    profiler = Profiler(config)
+    flask_app.before_request(profiler.begin)
+    flask_app.after_request(profiler.end)
+    flask_app.teardown_request(profiler.teardown)
+
+    def profiles():
+        profiler.check_token()
+        return jsonify(profiler.list())
+
+    flask_app.add_url_rule(config['PROFILER_PATH'], 'profiler_list', profiles)
+    flask_app.add_url_rule(config['PROFILER_PATH'] + '/<name>', 'profiler_summary', profiler.summary)
+    return profiler
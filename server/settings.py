@@ -18,4 +18,120 @@ RESTPLUS_ERROR_404_HELP = False
 # SQLALCHEMY_TRACK_MODIFICATIONS = False
 
 # Mongo DB settings
-MONGO_DBNAME = "reporting"
\ No newline at end of file
+MONGO_DBNAME = "reporting"
+MONGO_URI = "mongodb://localhost:27017/{}".format(MONGO_DBNAME)
+# create missing indexes at server startup, see server/db/indexes.py
+MONGO_ENSURE_INDEXES = True
+
+# max number of ids sent in a single $in query when loading data records
+DATA_RECORDS_CHUNK_SIZE = 1000
+# max number of documents in a single insert_many
+BULK_INSERT_CHUNK_SIZE = 1000
+
+# store jenkins payloads as native BSON subdocuments instead of json strings,
+# existing records are converted by server/db/migrate_jenkins_data.py
+JENKINS_DATA_NATIVE = True
+
+# jenkins ingestion (server/db/fetch_jenkins_info.py)
+INGEST_WORKERS = 16
+INGEST_SITE_CONCURRENCY = 4
+INGEST_RETRIES = 3
+# seconds, doubled on every retry
+INGEST_RETRY_BACKOFF = 1.0
+# seconds between progress lines
+INGEST_PROGRESS_INTERVAL = 5
+# max number of concurrent jenkins requests of async ingestion (server/db/async_ingest.py)
+ASYNC_INGEST_MAX_IN_FLIGHT = 256
+
+# fields requested from jenkins with tree= queries per resource type, None requests full api/json.
+# Label parsers of BUILD_INFO_API labels only see the fields listed for 'build'.
+# Jobs list allBuilds, jenkins caps builds at the 100 newest
+JENKINS_TREE = {
+    'site': "mode,nodeName,nodeDescription,numExecutors,description,jobs[name,url,color]",
+    'job': "name,fullName,displayName,url,description,buildable,color,inQueue,"
+           "lastBuild[number],lastCompletedBuild[number],allBuilds[number,url]",
+    'build': "id,number,url,displayName,fullDisplayName,description,result,building,"
+             "timestamp,duration,estimatedDuration,builtOn,"
+             "artifacts[fileName,relativePath],"
+             "actions[parameters[name,value],causes[shortDescription]]",
+    'testReport': "duration,empty,failCount,passCount,skipCount,"
+                  "suites[name,id,duration,timestamp,enclosingBlockNames,"
+                  "cases[className,name,status,duration,age,errorDetails,errorStackTrace,"
+                  "skipped,skippedMessage,failedSince]]",
+}
+# arrays fetched in pages of JENKINS_TREE_PAGE_SIZE items per resource type, 0 disables paging
+JENKINS_TREE_PAGED = {
+    'job': 'allBuilds',
+    'testReport': 'cases',
+}
+JENKINS_TREE_PAGE_SIZE = 1000
+
+# connection pools to jenkins sites (server/api/jenkins_http.py)
+JENKINS_HTTP_POOL_CONNECTIONS = 4
+# max kept-alive connections per host, should be >= INGEST_SITE_CONCURRENCY
+JENKINS_HTTP_POOL_MAXSIZE = 16
+# (connect, read) timeouts, seconds
+JENKINS_HTTP_TIMEOUT = (10, 300)
+JENKINS_HTTP_ACCEPT_ENCODING = "gzip, deflate"
+# number of latest requests per site used for latency percentiles
+JENKINS_HTTP_LATENCY_SAMPLES = 1000
+
+# in-process read-through cache (server/db/cache.py), TTL in seconds per collection,
+# collections not listed here are not cached
+CACHE_TTL = {
+    'jenkins_sites': 300,
+    'jenkins_jobs': 60,
+    'jenkins_labels': 300,
+}
+# max number of cached queries per collection
+CACHE_MAX_ENTRIES = 256
+
+# ETags and conditional GET (If-None-Match) on list endpoints,
+# based on collection versions bumped by the model classes
+ETAG_ENABLED = True
+
+# build artifacts
+ARTIFACT_DOWNLOAD_WORKERS = 8
+# larger artifacts are not downloaded
+ARTIFACT_MAX_BYTES = 100 * 1024 * 1024
+# larger artifacts are stored in GridFS instead of jenkins_data records
+ARTIFACT_INLINE_MAX_BYTES = 4 * 1024 * 1024
+
+# /info endpoints queue jenkins fetches on a miss and return 202 with a ticket,
+# the queue is served by FETCH_QUEUE_WORKERS threads of every report server process,
+# started with the first request the process serves
+FETCH_QUEUE_ENABLED = True
+FETCH_QUEUE_WORKERS = 4
+FETCH_QUEUE_MAX_ATTEMPTS = 3
+# seconds before the first retry of a failed fetch, doubled on every further attempt
+FETCH_QUEUE_RETRY_BACKOFF = 5
+# seconds after which a running fetch is taken over by another worker
+FETCH_QUEUE_CLAIM_TIMEOUT = 600
+# seconds between polls of an empty queue
+FETCH_QUEUE_POLL_INTERVAL = 1
+
+# single-flight jenkins fetches (server/db/singleflight.py), seconds
+SINGLE_FLIGHT_TIMEOUT = 600
+SINGLE_FLIGHT_CLAIM_TTL = 600
+SINGLE_FLIGHT_POLL_INTERVAL = 0.5
+
+# Request metrics (server/metrics.py)
+METRICS_ENABLED = True
+METRICS_PATH = "/metrics"
+# add Server-Timing header with app, mongo, jenkins and serialization time to responses
+METRICS_SERVER_TIMING = False
+# upper bounds (seconds) of the request duration histogram
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Request profiler (server/profiler.py), see the module docstring
+PROFILER_ENABLED = False
+# "cprofile" or "sample"
+PROFILER_MODE = "cprofile"
+PROFILER_THRESHOLD = 1.0
+PROFILER_SAMPLE_RATE = 0.0
+PROFILER_SAMPLE_INTERVAL = 0.005
+PROFILER_DIR = "profiles/server"
+PROFILER_MAX_FILES = 100
+PROFILER_PATH = "/admin/profiles"
+PROFILER_TOP_N = 30
+PROFILER_TOKEN = os.environ.get("PROFILER_TOKEN")
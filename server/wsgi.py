@@ -0,0 +1,11 @@
+# This source code is licensed under the Apache license found in the
+# LICENSE file in the root directory of this project.
+
+"""
+WSGI entrypoint of the report server, run from the repository root:
+
+    gunicorn -w 4 -b 0.0.0.0:8888 server.wsgi:app
+"""
+from server.app import app, initialize_app
+
+initialize_app(app)